@@ -0,0 +1,93 @@
+# Ad cooldown under concurrent taps, against a local MongoDB: every user taps a gated button
+# many times at once, from two "processes" (two Database instances, like both bots) and again
+# after the cooldown ends. Checks that exactly one ad is shown per user per cooldown window and
+# reports the Mongo round trips saved by the in-process cooldown cache.
+# Uses a scratch database that is dropped afterwards.
+# Usage: MONGO_URI=mongodb://localhost:27017 python benchmarks/bench_ad_cooldown.py [--users 200] [--taps 20]
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = "bench_ad_cooldown"
+
+from config import Config
+from database import Database
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def burst(dbs, users, taps, cooldown, timings):
+    # -> ads shown per user
+    async def tap(db, user_id):
+        started = time.perf_counter()
+        shown = await db.claim_ad_slot(user_id, cooldown)
+        timings.append((time.perf_counter() - started) * 1000)
+        return user_id, shown
+
+    results = await asyncio.gather(*(
+        tap(dbs[i % len(dbs)], user_id) for user_id in range(users) for i in range(taps)
+    ))
+    shown = {}
+    for user_id, was_shown in results:
+        shown[user_id] = shown.get(user_id, 0) + was_shown
+    return shown
+
+
+def check(label, shown, users):
+    wrong = {user_id: count for user_id, count in shown.items() if count != 1}
+    status = "ok" if not wrong and len(shown) == users else f"FAILED ({len(wrong)} users got {sorted(set(wrong.values()))} ads)"
+    print(f"  {label:<22} {sum(shown.values())} ads for {users} users: {status}")
+    return not wrong
+
+
+async def run(args):
+    dbs = [Database(), Database()]
+    await dbs[0].client.drop_database(Config.DB_NAME)
+    await dbs[0].ensure_indexes()
+
+    print(f"{args.users} users x {args.taps} concurrent taps over two processes, cooldown {args.cooldown}s")
+    timings = []
+    ok = check("first burst", await burst(dbs, args.users, args.taps, args.cooldown, timings), args.users)
+
+    # Inside the cooldown: nobody sees an ad, and repeat taps are answered from memory
+    timings_cached = []
+    shown = await burst(dbs, args.users, args.taps, args.cooldown, timings_cached)
+    inside = sum(shown.values())
+    print(f"  {'inside cooldown':<22} {inside} ads: {'ok' if inside == 0 else 'FAILED'}")
+    ok = ok and inside == 0
+
+    # After the cooldown, with the in-process cache dropped so every tap goes to Mongo again
+    await asyncio.sleep(args.cooldown)
+    for db in dbs:
+        db.ad_cooldowns.clear()
+    ok = check("after cooldown", await burst(dbs, args.users, args.taps, args.cooldown, timings), args.users) and ok
+
+    lookups = sum(db.ad_cooldowns.hits + db.ad_cooldowns.misses for db in dbs)
+    hits = sum(db.ad_cooldowns.hits for db in dbs)
+    print(f"  claim latency p50 {percentile(timings, 50):.3f} ms p99 {percentile(timings, 99):.3f} ms (Mongo); "
+          f"cached p50 {percentile(timings_cached, 50):.4f} ms")
+    print(f"  {hits}/{lookups} taps answered without a round trip")
+
+    await dbs[0].client.drop_database(Config.DB_NAME)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--taps", type=int, default=20)
+    parser.add_argument("--cooldown", type=float, default=2)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# DeliveryQueue against a stub Telegram that enforces rate limits by raising FloodWait.
+# Simulates a popular episode drop: many users requesting files at once, a few of them greedy.
+# Usage: python benchmarks/bench_delivery.py [--users 300] [--greedy 10] [--files 20]
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyrogram.errors import FloodWait
+from delivery import DeliveryQueue, TokenBucket
+
+
+class StubTelegram:
+    # Accepts sends within Telegram's limits (about 30/s per bot, about 1/s per chat with a
+    # small burst) and raises FloodWait otherwise. Every send takes some network latency.
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, latency=0.05, error_rate=0.01):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chat_buckets = {}
+        self.sent = 0
+        self.floods = 0
+        self.errors = 0
+
+    async def copy_message(self, chat_id):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        now = time.monotonic()
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        wait = max(bucket.wait_time(now), self.global_bucket.wait_time(now))
+        if wait > 0:
+            self.floods += 1
+            raise FloodWait(value=max(1, int(wait + 0.999)))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise ConnectionError("stub network error")
+        bucket.take(now)
+        self.global_bucket.take(now)
+        self.sent += 1
+        return {"chat_id": chat_id, "message_id": self.sent}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+async def run(args):
+    telegram = StubTelegram()
+    queue = DeliveryQueue(
+        global_rate=args.global_rate, chat_rate=args.chat_rate, chat_burst=args.chat_burst,
+        max_pending=100000, max_per_chat=args.files, max_retries=5, concurrency=args.concurrency
+    )
+    queue.start()
+
+    # chat_id -> seconds until its first / last file arrived
+    first, last = {}, {}
+    started = time.monotonic()
+
+    async def request(chat_id):
+        sent = await queue.submit(chat_id, lambda: telegram.copy_message(chat_id))
+        if sent is not None:
+            elapsed = time.monotonic() - started
+            first.setdefault(chat_id, elapsed)
+            last[chat_id] = elapsed
+
+    futures = []
+    for chat_id in range(args.users):
+        files = args.files if chat_id < args.greedy else 1
+        futures += [request(chat_id) for _ in range(files)]
+    random.shuffle(futures)
+    await asyncio.gather(*futures)
+    elapsed = time.monotonic() - started
+    await queue.stop()
+
+    stats = queue.stats()
+    casual = [first[c] for c in range(args.greedy, args.users) if c in first]
+    print(f"{len(futures)} deliveries to {args.users} chats ({args.greedy} asking for {args.files} files) in {elapsed:.1f}s")
+    print(f"  delivered {stats['delivered']}, failed {stats['failed']}, retries {stats['retries']}, "
+          f"FloodWaits {stats['flood_waits']} ({telegram.floods} raised by stub), network errors {telegram.errors}")
+    print(f"  throughput {stats['delivered'] / elapsed:.1f} msg/s (Telegram allows ~30)")
+    print(f"  latency p50 {stats['latency_p50']:.2f}s p99 {stats['latency_p99']:.2f}s")
+    print(f"  single-file users served after p50 {percentile(casual, 50):.2f}s p99 {percentile(casual, 99):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--greedy", type=int, default=10)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--global-rate", type=float, default=25)
+    parser.add_argument("--chat-rate", type=float, default=1)
+    parser.add_argument("--chat-burst", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
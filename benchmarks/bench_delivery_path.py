@@ -0,0 +1,90 @@
+# Latency of the /start <file id> lookup before the send, old path vs cached path, against a
+# local MongoDB. Uses a scratch database that is dropped afterwards.
+# Usage: MONGO_URI=mongodb://localhost:27017 python benchmarks/bench_delivery_path.py [--files 10000] [--requests 5000]
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = "bench_delivery_path"
+
+from config import Config
+from database import Database
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def seed(db, files):
+    await db.client.drop_database(Config.DB_NAME)
+    docs = [{
+        "anime_id": i % 500, "anime_name": f"Anime {i % 500}", "season": 1, "episode": i // 500 + 1,
+        "quality": "720p", "audio": "Original", "message_id": i, "chat_id": -100, "added_at": time.time()
+    } for i in range(files)]
+    result = await db.index_cache.insert_many(docs)
+    await db.set_setting("caption_mode", 2)
+    return [str(_id) for _id in result.inserted_ids]
+
+
+async def old_path(db, file_id):
+    # Before: file, then setting, then the view write, one after another
+    from bson.objectid import ObjectId
+    file_doc = await db.index_cache.find_one({"_id": ObjectId(file_id)})
+    await db.settings.find_one({"key": "caption_mode"})
+    # (copy_message happened here)
+    await db.trending.update_one({"anime_name": file_doc["anime_name"]}, {"$inc": {"view_count": 1}}, upsert=True)
+
+
+async def new_path(db, file_id):
+    file_doc, _ = await asyncio.gather(db.get_file(file_id), db.get_cached_setting("caption_mode", Config.CAPTION_MODE))
+    # (copy_message happens here)
+    await db.increase_view(file_doc["anime_id"], file_doc["anime_name"])
+
+
+async def measure(label, path, db, requests):
+    timings = []
+    for file_id in requests:
+        started = time.perf_counter()
+        await path(db, file_id)
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f"  {label:<14} p50 {percentile(timings, 50):7.3f} ms  p99 {percentile(timings, 99):7.3f} ms  "
+          f"total {sum(timings) / 1000:6.2f} s")
+
+
+async def run(args):
+    db = Database()
+    ids = await seed(db, args.files)
+    rng = random.Random(42)
+    # Popular episodes get most of the traffic, like a new release
+    hot = ids[:args.hot]
+    requests = [rng.choice(hot) if rng.random() < 0.8 else rng.choice(ids) for _ in range(args.requests)]
+
+    print(f"{args.requests} deep links over {args.files} files ({args.hot} hot)")
+    await measure("old path", old_path, db, requests)
+    db.start()
+    await measure("cached path", new_path, db, requests)
+    stats = db.file_cache.stats()
+    print(f"  file cache hit rate {stats['hit_rate']:.0%}, setting reads from Mongo: {db.setting_cache.misses}")
+
+    await db.close()
+    await db.client.drop_database(Config.DB_NAME)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--hot", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
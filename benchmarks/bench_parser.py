@@ -0,0 +1,78 @@
+# Accuracy and throughput of Parser on a corpus of real-world release names.
+# Usage: python benchmarks/bench_parser.py [--corpus benchmarks/parser_corpus.tsv] [--names 50000]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsing import Parser
+
+FIELDS = ("anime_name", "season", "episode", "quality", "audio")
+
+
+def load_corpus(path):
+    # text \t anime_name \t season \t episode \t quality \t audio; "-" = must not parse
+    cases = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line or line.startswith("#"):
+                continue
+            text, name, season, episode, quality, audio = line.split("\t")
+            expected = None if name == "-" else {
+                "anime_name": name, "season": int(season), "episode": int(episode), "quality": quality, "audio": audio
+            }
+            cases.append((text, expected))
+    return cases
+
+
+def accuracy(cases):
+    correct = 0
+    for text, expected in cases:
+        got = Parser.parse_info(text)
+        if got == expected:
+            correct += 1
+            continue
+        if expected is None or got is None:
+            print(f"  MISS {text!r}: expected {expected}, got {got}")
+        else:
+            diff = ", ".join(f"{field} {got[field]!r} != {expected[field]!r}" for field in FIELDS if got[field] != expected[field])
+            print(f"  MISS {text!r}: {diff}")
+    return correct
+
+
+def throughput(items, repeat_label):
+    started = time.perf_counter()
+    Parser.parse_many(items)
+    elapsed = time.perf_counter() - started
+    print(f"  {repeat_label:<28} {len(items):>8} names {len(items) / elapsed:>12,.0f} parses/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_corpus.tsv"))
+    parser.add_argument("--names", type=int, default=50000)
+    args = parser.parse_args()
+
+    cases = load_corpus(args.corpus)
+    print(f"Accuracy on {len(cases)} names")
+    correct = accuracy(cases)
+    print(f"  {correct}/{len(cases)} correct ({100 * correct / len(cases):.1f}%)")
+
+    texts = [text for text, _ in cases]
+    print("\nThroughput")
+    # Distinct names (a different release tag each), so every parse misses the cache
+    Parser.cache_clear()
+    unique = [(f"[{i:08X}] {texts[i % len(texts)]}", None) for i in range(args.names)]
+    throughput(unique, "distinct names (cold)")
+    # The corpus over and over, as when a channel is re-indexed
+    Parser.cache_clear()
+    repeated = [(texts[i % len(texts)], None) for i in range(args.names)]
+    throughput(repeated, "repeated names (memoized)")
+    print(f"  cache: {Parser.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
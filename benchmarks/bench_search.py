@@ -0,0 +1,111 @@
+# Per-query latency of the in-memory anime search at 10k and 100k titles.
+# Usage: python benchmarks/bench_search.py [--sizes 10000 100000] [--queries 2000]
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SearchIndex
+
+WORDS = [
+    "attack", "titan", "naruto", "shippuden", "one", "piece", "dragon", "ball", "super", "hunter",
+    "jujutsu", "kaisen", "demon", "slayer", "kimetsu", "yaiba", "sword", "art", "online", "tokyo",
+    "ghoul", "revengers", "my", "hero", "academia", "black", "clover", "fullmetal", "alchemist",
+    "brotherhood", "death", "note", "steins", "gate", "code", "geass", "mob", "psycho", "spy",
+    "family", "chainsaw", "man", "vinland", "saga", "blue", "lock", "frieren", "beyond", "journey",
+    "end", "oshi", "no", "ko", "re", "zero", "kara", "hajimeru", "isekai", "shokudou", "boku",
+    "kanojo", "love", "live", "school", "idol", "project", "gintama", "bleach", "thousand", "year",
+    "blood", "war", "haikyuu", "kuroko", "basket", "yuri", "ice", "made", "abyss", "golden", "kamuy",
+]
+
+
+SYLLABLES = ["ka", "ki", "ku", "ke", "ko", "sa", "shi", "su", "ta", "chi", "tsu", "na", "ni", "no",
+             "ha", "hi", "fu", "ma", "mi", "mu", "ya", "yu", "yo", "ra", "ri", "ru", "ro", "wa", "n"]
+
+
+def make_vocabulary(size, rng):
+    # Real anime words plus romaji-like made up ones, so postings lists have realistic sizes
+    words = set(WORDS)
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def make_titles(count, rng):
+    vocabulary = make_vocabulary(max(len(WORDS), count // 10), rng)
+    titles = set()
+    while len(titles) < count:
+        words = rng.sample(vocabulary, rng.randint(2, 5))
+        title = " ".join(w.capitalize() for w in words)
+        if rng.random() < 0.3:
+            title += f" {rng.choice(['II', 'III', 'Season 2', 'Movie', 'OVA', 'Final Season'])}"
+        titles.add(title)
+    return sorted(titles)
+
+
+def make_queries(titles, count, rng):
+    queries = []
+    for _ in range(count):
+        words = rng.choice(titles).lower().split()
+        kind = rng.choice(["exact", "prefix", "typo", "multi"])
+        word = rng.choice(words)
+        if kind == "exact":
+            queries.append((kind, word))
+        elif kind == "prefix":
+            queries.append((kind, word[:max(1, len(word) // 2)]))
+        elif kind == "typo" and len(word) > 4:
+            i = rng.randrange(len(word))
+            queries.append((kind, word[:i] + word[i + 1:]))
+        else:
+            queries.append(("multi", " ".join(words[:2])))
+    return queries
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(size, query_count, rng):
+    titles = make_titles(size, rng)
+    index = SearchIndex()
+    started = time.perf_counter()
+    index.rebuild(titles)
+    build = time.perf_counter() - started
+
+    timings = {}
+    for kind, query in make_queries(titles, query_count, rng):
+        started = time.perf_counter()
+        index.search(query)
+        timings.setdefault(kind, []).append((time.perf_counter() - started) * 1e6)
+
+    print(f"\n{size} titles (build {build:.2f}s)")
+    print(f"  {'query':<8} {'n':>6} {'mean us':>10} {'p50 us':>10} {'p99 us':>10}")
+    everything = []
+    for kind in sorted(timings):
+        values = timings[kind]
+        everything += values
+        print(f"  {kind:<8} {len(values):>6} {statistics.mean(values):>10.0f} "
+              f"{percentile(values, 50):>10.0f} {percentile(values, 99):>10.0f}")
+    print(f"  {'all':<8} {len(everything):>6} {statistics.mean(everything):>10.0f} "
+          f"{percentile(everything, 50):>10.0f} {percentile(everything, 99):>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for size in args.sizes:
+        run(size, args.queries, rng)
+
+
+if __name__ == "__main__":
+    main()
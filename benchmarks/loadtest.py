@@ -0,0 +1,318 @@
+# Load test of the real index bot and file bot handlers with synthetic Telegram traffic, against a
+# local MongoDB. Telegram is a stub client whose calls take a configurable latency; everything
+# else (update lanes, handlers, caches, Database, delivery queue) is the production code.
+# Per flow: throughput, handler latency p50/p99 and Mongo commands per request; for deliveries
+# also the queue's submit-to-send latency. Uses a scratch database that is dropped afterwards.
+# Usage: MONGO_URI=mongodb://localhost:27017 python benchmarks/loadtest.py [--users 1000] [--requests 2000]
+#        [--concurrency 50] [--anime 300] [--flows start,library,deliver,...]
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = "bench_loadtest"
+os.environ["DB_CHANNEL_ID"] = "-1001"
+os.environ["FORCE_JOIN_CHANNEL_ID"] = "0"
+os.environ["SYNC_ON_STARTUP"] = "0"
+# Both bots refuse to start without credentials; nothing here talks to Telegram
+os.environ["API_ID"] = "1"
+os.environ["API_HASH"] = "loadtest"
+os.environ["INDEX_BOT_TOKEN"] = "1:loadtest"
+os.environ["FILE_BOT_TOKENS"] = "2:loadtest"
+os.environ["FILE_BOT_USERNAMES"] = "LoadTestBot"
+os.environ["FILE_BOT_RUN"] = ""
+
+from pymongo import monitoring
+
+
+class CommandCounter(monitoring.CommandListener):
+    # Every Mongo command sent by any client created after registration
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+mongo_commands = CommandCounter()
+monitoring.register(mongo_commands) # Before database.py creates its client
+
+from config import Config
+from database import db
+try:
+    import index_bot
+    import file_bot
+except SystemExit:
+    # They exit() on missing settings, which would pass for a clean run
+    sys.exit("loadtest: index_bot/file_bot refused to start, see the log above")
+
+QUALITIES = ["480p", "720p", "1080p"]
+
+
+# --- STUB TELEGRAM ---
+
+class StubTelegram:
+    # Stands in for both the Pyrogram client and the messages/queries handlers reply through.
+    # Every call sleeps `latency` seconds (jittered) and is counted.
+    def __init__(self, latency):
+        self.latency = latency
+        self.me = SimpleNamespace(id=1000, username="LoadTestBot")
+        self.calls = 0
+        self.sent = 0
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    async def get_me(self):
+        await self.call()
+        return self.me
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, caption=None):
+        await self.call()
+        self.sent += 1
+        # As if the copy came back with this bot's own file_id
+        media = SimpleNamespace(file_id=f"bot-{from_chat_id}-{message_id}", file_unique_id=f"u-{message_id}")
+        return SimpleNamespace(document=media, video=None)
+
+    async def send_cached_media(self, chat_id, file_id, caption=None):
+        await self.call()
+        self.sent += 1
+        return SimpleNamespace(document=SimpleNamespace(file_id=file_id, file_unique_id=None), video=None)
+
+    async def send_media_group(self, chat_id, media):
+        await self.call()
+        self.sent += len(media)
+        return [SimpleNamespace(document=None, video=None) for _ in media]
+
+
+class FakeMessage:
+    def __init__(self, telegram, user_id, text=None, **fields):
+        self.telegram = telegram
+        self.from_user = SimpleNamespace(id=user_id, first_name=f"User {user_id}", username=f"user{user_id}")
+        self.chat = SimpleNamespace(id=user_id)
+        self.text = text
+        self.command = text[1:].split() if text and text.startswith("/") else None
+        self.__dict__.update(fields)
+
+    async def reply_text(self, text, reply_markup=None):
+        await self.telegram.call()
+
+    async def edit_text(self, text, reply_markup=None):
+        await self.telegram.call()
+
+
+class FakeQuery:
+    def __init__(self, telegram, user_id, data):
+        self.telegram = telegram
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = FakeMessage(telegram, user_id)
+
+    async def answer(self, text=None, show_alert=False):
+        await self.telegram.call()
+
+
+def channel_upload(telegram, message_id, anime_name, episode, quality):
+    document = SimpleNamespace(
+        file_name=f"[Sub] {anime_name} - {episode:02d} [{quality}].mkv", file_id=f"idx-{message_id}",
+        file_unique_id=f"u-{message_id}", file_size=350 << 20, mime_type="video/x-matroska"
+    )
+    return FakeMessage(telegram, 0, id=message_id, chat=SimpleNamespace(id=Config.DB_CHANNEL_ID),
+                       document=document, video=None, caption=None)
+
+
+# --- SEED ---
+
+async def seed(args):
+    await db.client.drop_database(Config.DB_NAME)
+    await db.ensure_indexes()
+    files = []
+    message_id = 0
+    for a in range(args.anime):
+        for season in range(1, args.seasons + 1):
+            for episode in range(1, args.episodes + 1):
+                for quality in QUALITIES:
+                    message_id += 1
+                    files.append({
+                        "anime_name": f"Anime {a:04d}", "season": season, "episode": episode, "quality": quality,
+                        "audio": "Japanese", "message_id": message_id, "chat_id": Config.DB_CHANNEL_ID,
+                        "media_type": "document", "file_id": f"idx-{message_id}", "file_unique_id": f"u-{message_id}",
+                        "file_size": 350 << 20, "mime_type": "video/x-matroska", "duration": None, "caption": None
+                    })
+    for i in range(0, len(files), Config.INDEX_BATCH_SIZE):
+        await db.save_files(files[i:i + Config.INDEX_BATCH_SIZE])
+    file_ids = [str(doc["_id"]) async for doc in db.index_cache.find({}, {"_id": 1})]
+    anime_ids = [doc["_id"] async for doc in db.anime.find({}, {"_id": 1})]
+    return file_ids, anime_ids, message_id
+
+
+# --- FLOWS ---
+
+async def dispatch(handler, client, update):
+    # As Pyrogram would: through the handler's lane, waiting until it has run
+    done = handler.submit(client, update)
+    if done is None:
+        raise RuntimeError("lane full, update dropped")
+    await done
+
+
+def make_flows(telegram, file_ids, anime_ids, args, next_message_id):
+    # name -> async fn(user_id, rng), one request each, through the real handlers
+    def query(handler, data):
+        return lambda user_id, rng: dispatch(handler, telegram, FakeQuery(telegram, user_id, data(rng)))
+
+    async def upload(user_id, rng):
+        message_id = next(next_message_id)
+        await dispatch(index_bot.auto_index_handler, telegram, channel_upload(
+            telegram, message_id, f"Fresh Release {message_id % 50}", message_id % 500 + 1, rng.choice(QUALITIES)))
+
+    return {
+        "start": lambda user_id, rng: dispatch(index_bot.start_handler, telegram, FakeMessage(telegram, user_id, "/start")),
+        "library": query(index_bot.nav_handler, lambda rng: "nav_library"),
+        "lib_gt": query(index_bot.library_page_handler, lambda rng: f"lib_gt_{rng.choice(anime_ids)}"),
+        "lib_lt": query(index_bot.library_page_handler, lambda rng: f"lib_lt_{rng.choice(anime_ids)}"),
+        "lib_jump": query(index_bot.library_page_handler, lambda rng: f"lib_ge_{rng.choice(index_bot.LIBRARY_JUMPS[1:])}"),
+        "latest": query(index_bot.nav_handler, lambda rng: "nav_latest"),
+        "trending": query(index_bot.nav_handler, lambda rng: rng.choice(["nav_trending", "nav_trending_7d", "nav_trending_all"])),
+        "anime": query(index_bot.anime_view_handler, lambda rng: f"anime_{rng.choice(anime_ids)}"),
+        "season": query(index_bot.season_view_handler, lambda rng: f"season_{rng.choice(anime_ids)}_{rng.randint(1, args.seasons)}"),
+        "file": query(index_bot.file_details_handler, lambda rng: f"file_{rng.choice(file_ids)}"),
+        "search": lambda user_id, rng: dispatch(index_bot.search_handler,
+            telegram, FakeMessage(telegram, user_id, f"anime {rng.randrange(args.anime):04d}"[:rng.randint(4, 10)])),
+        "deliver": lambda user_id, rng: dispatch(file_bot.start_handler,
+            telegram, FakeMessage(telegram, user_id, f"/start {rng.choice(file_ids)}")),
+        "upload": upload,
+    }
+
+
+# --- RUN ---
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+def handler_errors():
+    # Handlers' exceptions are caught and counted by their lane
+    return sum(lane.errors for bot in (index_bot, file_bot) for lane in bot.lanes.lanes.values())
+
+
+def handlers_run():
+    return sum(lane.processed for bot in (index_bot, file_bot) for lane in bot.lanes.lanes.values())
+
+
+async def run_flow(name, flow, args, rng):
+    # `requests` requests from random users, at most `concurrency` at once (like Pyrogram's workers;
+    # the lanes then apply their own limits)
+    slots = asyncio.Semaphore(args.concurrency)
+    timings = []
+    errors = 0
+
+    async def one(user_id):
+        nonlocal errors
+        async with slots:
+            started = time.perf_counter()
+            try:
+                await flow(user_id, rng)
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"  {name}: {type(e).__name__}: {e}")
+            timings.append((time.perf_counter() - started) * 1000)
+
+    commands = mongo_commands.count
+    failed = handler_errors()
+    processed = handlers_run()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(rng.randrange(args.users)) for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    errors += handler_errors() - failed
+    per_request = (mongo_commands.count - commands) / args.requests
+    print(f"  {name:<9} {args.requests / elapsed:8.0f} req/s  p50 {percentile(timings, 50):7.2f} ms  "
+          f"p99 {percentile(timings, 99):7.2f} ms  max {max(timings):7.2f} ms  "
+          f"{per_request:5.2f} Mongo cmds/req  {errors} errors")
+    if handlers_run() == processed:
+        print(f"  {name}: FAILED, no handler ran")
+        return False
+    return True
+
+
+async def run(args):
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+    file_ids, anime_ids, last_message_id = await seed(args)
+    next_message_id = iter(range(last_message_id + 1, 1 << 40))
+
+    # Startup as in both bots' main()
+    await db.load_catalog()
+    await db.load_known_users()
+    await db.load_latest()
+    db.start()
+    index_bot.lanes.start()
+    file_bot.lanes.start()
+
+    telegram = StubTelegram(args.latency / 1000)
+    # The stub stands in for the first delivery bot
+    delivery = file_bot.deliveries[file_bot.app]
+    file_bot.deliveries = {telegram: delivery}
+    delivery.start()
+    flows = make_flows(telegram, file_ids, anime_ids, args, next_message_id)
+    selected = args.flows.split(",") if args.flows else list(flows)
+
+    print(f"{len(file_ids)} files, {len(anime_ids)} anime; {args.requests} requests per flow from {args.users} users, "
+          f"concurrency {args.concurrency}, Telegram latency {args.latency} ms")
+    ok = True
+    for name in selected:
+        ok = await run_flow(name, flows[name], args, rng) and ok
+
+    if "deliver" in selected:
+        # Sends are queued behind the rate limits; wait for the queue to drain
+        while delivery.stats()["queued"] or delivery.stats()["in_flight"]:
+            await asyncio.sleep(0.1)
+        stats = delivery.stats()
+        print(f"  delivery queue: {stats['delivered']} sent, {stats['failed']} failed, "
+              f"submit to send p50 {stats['latency_p50']:.2f}s p99 {stats['latency_p99']:.2f}s")
+    print(f"  {telegram.calls} stub Telegram calls; file cache {db.file_cache.stats()['hit_rate']:.0%} hits, "
+          f"catalog {db.catalog.stats()['hit_rate']:.0%} hits, page cache {index_bot.render_cache.stats()['hit_rate']:.0%} hits")
+
+    await index_bot.lanes.stop()
+    await file_bot.lanes.stop()
+    await delivery.stop()
+    await db.close()
+    await db.client.drop_database(Config.DB_NAME)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per flow")
+    parser.add_argument("--concurrency", type=int, default=50, help="Requests in flight (Pyrogram workers)")
+    parser.add_argument("--anime", type=int, default=300)
+    parser.add_argument("--seasons", type=int, default=2)
+    parser.add_argument("--episodes", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=20, help="Stub Telegram call latency, ms")
+    parser.add_argument("--flows", default="", help="Comma-separated: start,library,lib_gt,lib_lt,lib_jump,latest,trending,anime,season,file,search,deliver,upload")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
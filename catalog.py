@@ -0,0 +1,243 @@
+import bisect
+from collections import OrderedDict, deque
+from search import SearchIndex
+
+# index_cache fields kept in memory; everything the browse pages need
+CATALOG_FIELDS = ("anime_id", "anime_name", "season", "episode", "quality", "audio", "added_at", "message_id", "chat_id")
+
+# Fields of a Latest Episodes entry; file_id is the index_cache _id
+LATEST_FIELDS = ("file_id", "anime_id", "anime_name", "season", "episode", "quality", "added_at")
+
+
+class CatalogCache:
+    # In-process copy of the catalog.
+    # Every `anime` document (id, name, per-season summary) is kept, so anime and season pages,
+    # the library and search never leave memory. Episode lists live in per-anime trees
+    # (season -> episode -> {quality: file doc}) kept in LRU order and evicted once more than
+    # max_files documents are cached; an evicted anime is reloaded from Mongo on its next lookup.
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self._anime = {}             # anime_id -> anime doc
+        self._ids = {}               # name -> anime_id
+        self._keys = []              # Sorted library_key()s of anime that have files
+        self.search = SearchIndex()  # Title search over the same names
+        self._tree = OrderedDict()   # anime_id -> {season: {episode: {quality: doc}}}, LRU order
+        self._sizes = {}             # anime_id -> cached file count
+        self._files = 0
+
+    # --- LOOKUPS ---
+    def get_anime(self, anime_id):
+        self.hits += 1
+        return self._anime.get(anime_id)
+
+    def anime_id(self, anime_name):
+        return self._ids.get(anime_name)
+
+    def anime_names(self):
+        self.hits += 1
+        return [library_name(key) for key in self._keys]
+
+    def anime_page(self, start=None, before=None, limit=20):
+        # start/before are library keys (see library_key)
+        self.hits += 1
+        keys, has_prev, has_next = keyset_page(self._keys, start, before, limit)
+        return [self._anime[self._ids[library_name(key)]] for key in keys], has_prev, has_next
+
+    def search_anime(self, query, limit=50):
+        return [self._anime[self._ids[name]] for name in self.search.search(query, limit=limit)]
+
+    def episodes(self, anime_id, season):
+        # None = not cached, ask Mongo
+        seasons = self._tree.get(anime_id)
+        if seasons is None:
+            if self._anime.get(anime_id, {}).get("file_count"):
+                self.misses += 1
+                return None
+            seasons = {}
+        else:
+            self._tree.move_to_end(anime_id)
+        self.hits += 1
+        episodes = seasons.get(season, {})
+        return [episodes[ep][q] for ep in sorted(episodes) for q in sorted(episodes[ep])]
+
+    # --- WRITES ---
+    def reset(self, anime_docs):
+        self._anime.clear()
+        self._ids.clear()
+        self._keys = []
+        self._tree.clear()
+        self._sizes.clear()
+        self._files = 0
+        for doc in anime_docs:
+            self._anime[doc["_id"]] = doc
+            self._ids[doc["name"]] = doc["_id"]
+            if doc.get("file_count"):
+                self._keys.append(library_key(doc["name"]))
+        self._keys.sort()
+        self.search.rebuild([library_name(key) for key in self._keys])
+        self.loaded = True
+
+    def set_anime(self, doc):
+        # New or refreshed anime summary; only anime with files are listed
+        self._anime[doc["_id"]] = doc
+        self._ids[doc["name"]] = doc["_id"]
+        name = doc["name"]
+        key = library_key(name)
+        i = bisect.bisect_left(self._keys, key)
+        listed = i < len(self._keys) and self._keys[i] == key
+        if doc.get("file_count") and not listed:
+            self._keys.insert(i, key)
+            self.search.add(name)
+        elif not doc.get("file_count") and listed:
+            del self._keys[i]
+            self.search.remove(name)
+            self._drop(doc["_id"])
+
+    def update_anime(self, anime_id, fields):
+        doc = self._anime.get(anime_id)
+        if doc is not None:
+            self.set_anime(dict(doc, **fields))
+
+    def put_files(self, anime_id, docs):
+        # Cache a complete tree (all files of one anime)
+        self._drop(anime_id)
+        seasons = {}
+        for doc in docs:
+            seasons.setdefault(doc["season"], {}).setdefault(doc["episode"], {})[doc["quality"]] = _compact(doc)
+        self._tree[anime_id] = seasons
+        self._sizes[anime_id] = len(docs)
+        self._files += len(docs)
+        self._evict(keep=anime_id)
+
+    def add_file(self, doc):
+        # Write-through for a saved file
+        anime_id = doc["anime_id"]
+        seasons = self._tree.get(anime_id)
+        if seasons is None:
+            if self._anime.get(anime_id, {}).get("file_count"):
+                return # Evicted tree, reloaded on its next lookup
+            # First file of a new anime: the tree is complete by definition
+            seasons = self._tree[anime_id] = {}
+            self._sizes[anime_id] = 0
+        qualities = seasons.setdefault(doc["season"], {}).setdefault(doc["episode"], {})
+        if doc["quality"] not in qualities:
+            self._sizes[anime_id] += 1
+            self._files += 1
+        qualities[doc["quality"]] = _compact(doc)
+        self._evict(keep=anime_id)
+
+    def remove_file(self, doc):
+        seasons = self._tree.get(doc.get("anime_id"))
+        if seasons is None:
+            return
+        episodes = seasons.get(doc["season"], {})
+        qualities = episodes.get(doc["episode"], {})
+        if qualities.pop(doc["quality"], None) is not None:
+            self._sizes[doc["anime_id"]] -= 1
+            self._files -= 1
+        if not qualities:
+            episodes.pop(doc["episode"], None)
+        if not episodes:
+            seasons.pop(doc["season"], None)
+
+    def invalidate(self, anime_id):
+        # Files changed in bulk: forget the tree, the next lookup reloads it
+        self._drop(anime_id)
+
+    def has_room(self, files):
+        return self._files + files <= self.max_files
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "anime": len(self._keys),
+            "cached_anime": len(self._tree),
+            "cached_files": self._files,
+            "max_files": self.max_files,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _drop(self, anime_id):
+        if self._tree.pop(anime_id, None) is not None:
+            self._files -= self._sizes.pop(anime_id)
+
+    def _evict(self, keep):
+        while self._files > self.max_files and len(self._tree) > 1:
+            oldest = next(iter(self._tree))
+            if oldest == keep:
+                self._tree.move_to_end(keep)
+                continue
+            self._drop(oldest)
+
+
+class LatestFeed:
+    # The most recently indexed episodes, newest first; the in-memory side of the capped
+    # latest_episodes collection. Entries are only added the first time a file is indexed.
+    def __init__(self, maxlen):
+        self.loaded = False
+        self._entries = deque(maxlen=maxlen)
+
+    def reset(self, entries):
+        # entries newest first
+        self._entries.clear()
+        self._entries.extend(entries)
+        self.loaded = True
+
+    def push(self, entries):
+        # entries oldest first
+        for entry in entries:
+            self._entries.appendleft(entry)
+
+    def page(self, page=0, limit=10):
+        # (entries, has_next)
+        start = page * limit
+        entries = [self._entries[i] for i in range(start, min(start + limit, len(self._entries)))]
+        return entries, start + limit < len(self._entries)
+
+    def file_ids(self):
+        return {entry["file_id"] for entry in self._entries}
+
+    def remove(self, file_ids):
+        file_ids = set(file_ids)
+        kept = [entry for entry in self._entries if entry["file_id"] not in file_ids]
+        if len(kept) != len(self._entries):
+            self._entries.clear()
+            self._entries.extend(kept)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def library_key(name):
+    # Library order: case-insensitive ("naruto" under N), ties broken by the exact name so every
+    # title has a key of its own. Stored on anime docs as sort_key for the query fallback.
+    return f"{name.casefold()}\x00{name}"
+
+
+def library_name(key):
+    return key.split("\x00", 1)[1]
+
+
+def keyset_page(names, start=None, before=None, limit=20):
+    # Page of sorted keys: the first `limit` keys >= start, or the last `limit` keys < before.
+    # Returns (page, has_prev, has_next)
+    if before is not None:
+        end = bisect.bisect_left(names, before)
+        begin = max(0, end - limit)
+    else:
+        begin = bisect.bisect_left(names, start or "")
+        end = min(len(names), begin + limit)
+    return names[begin:end], begin > 0, end < len(names)
+
+
+def _compact(doc):
+    compact = {"_id": doc["_id"]}
+    for field in CATALOG_FIELDS:
+        if field in doc:
+            compact[field] = doc[field]
+    return compact
@@ -11,6 +11,19 @@ class Config:
     INDEX_BOT_TOKEN = os.getenv("INDEX_BOT_TOKEN", "")
     FILE_BOT_TOKEN = os.getenv("FILE_BOT_TOKEN", "")
     FILE_BOT_USERNAME = os.getenv("FILE_BOT_USERNAME", "FileDeliveryBot")
+    # Delivery bot pool (space separated, same order in both lists); defaults to the single bot above
+    FILE_BOT_TOKENS = os.getenv("FILE_BOT_TOKENS", FILE_BOT_TOKEN).split()
+    FILE_BOT_USERNAMES = os.getenv("FILE_BOT_USERNAMES", FILE_BOT_USERNAME).split()
+    # Positions in FILE_BOT_TOKENS this file_bot process runs, e.g. "0 1"; empty = all of them
+    FILE_BOT_RUN = [int(x) for x in os.getenv("FILE_BOT_RUN", "").split()]
+    # A bot leaves new links while FloodWaits of at least BOT_UNHEALTHY_FLOOD_SECONDS hit
+    # BOT_UNHEALTHY_FLOOD_CHATS different chats within BOT_UNHEALTHY_FLOOD_WINDOW seconds,
+    # or for BOT_UNHEALTHY_ERROR_SECONDS after an auth/connection error
+    BOT_UNHEALTHY_FLOOD_SECONDS = int(os.getenv("BOT_UNHEALTHY_FLOOD_SECONDS", "10"))
+    BOT_UNHEALTHY_FLOOD_CHATS = int(os.getenv("BOT_UNHEALTHY_FLOOD_CHATS", "3"))
+    BOT_UNHEALTHY_FLOOD_WINDOW = int(os.getenv("BOT_UNHEALTHY_FLOOD_WINDOW", "60"))
+    BOT_UNHEALTHY_ERROR_SECONDS = int(os.getenv("BOT_UNHEALTHY_ERROR_SECONDS", "60"))
+    BOT_HEALTH_CACHE_TTL = int(os.getenv("BOT_HEALTH_CACHE_TTL", "15")) # How often the index bot re-reads bot health
 
     
     # Database
@@ -18,14 +31,78 @@ class Config:
     DB_NAME = os.getenv("DB_NAME", "anime_bot_db")
     
     # Channels & Admins
-    DB_CHANNEL_ID = int(os.getenv("DB_CHANNEL_ID", "0")) # Private Channel ID
+    # Private storage channels, space separated; files are indexed from all of them.
+    # A single DB_CHANNEL_ID still works.
+    DB_CHANNEL_IDS = [int(x) for x in os.getenv("DB_CHANNEL_IDS", os.getenv("DB_CHANNEL_ID", "")).split()]
+    DB_CHANNEL_ID = DB_CHANNEL_IDS[0] if DB_CHANNEL_IDS else 0 # Files indexed before chat_id was recorded
     # Support ADMINS or ADMIN_IDS
     ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", os.getenv("ADMINS", "")).split()]
     
     # Force Join
     FORCE_JOIN_CHANNEL_ID = int(os.getenv("FORCE_JOIN_CHANNEL_ID", "0"))
     FORCE_JOIN_CHANNEL_LINK = os.getenv("FORCE_JOIN_CHANNEL_LINK", "")
+    MEMBERSHIP_POSITIVE_TTL = int(os.getenv("MEMBERSHIP_POSITIVE_TTL", "600")) # Seconds a "joined" result is trusted
+    MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "30")) # Seconds a "not joined" result is trusted
+    MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
     
     # Settings
     NEW_EPISODE_HIGHLIGHT_HOURS = 24
+    LIBRARY_PAGE_SIZE = int(os.getenv("LIBRARY_PAGE_SIZE", "20"))
+    SEASON_PAGE_SIZE = int(os.getenv("SEASON_PAGE_SIZE", "48")) # Episode buttons per season page
+    LATEST_PAGE_SIZE = int(os.getenv("LATEST_PAGE_SIZE", "10"))
+    LATEST_FEED_SIZE = int(os.getenv("LATEST_FEED_SIZE", "200")) # Episodes kept in Latest Episodes
     CAPTION_MODE = int(os.getenv("CAPTION_MODE", "2")) # 1=Original, 2=Clean, 3=No Caption
+    AD_COOLDOWN_SECONDS = int(os.getenv("AD_COOLDOWN_SECONDS", "3600")) # At most one ad per user in this window
+
+    # Caches
+    CATALOG_MAX_FILES = int(os.getenv("CATALOG_MAX_FILES", "200000")) # Files kept in the in-memory catalog
+    RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "5000")) # Pre-rendered anime/season pages
+    FAVORITES_CACHE_SIZE = int(os.getenv("FAVORITES_CACHE_SIZE", "100000"))
+    FAVORITES_CACHE_TTL = int(os.getenv("FAVORITES_CACHE_TTL", "600"))
+    FILE_CACHE_SIZE = int(os.getenv("FILE_CACHE_SIZE", "50000")) # File documents kept for deep links
+    FILE_CACHE_TTL = int(os.getenv("FILE_CACHE_TTL", "300"))
+    FILE_CACHE_NEGATIVE_TTL = int(os.getenv("FILE_CACHE_NEGATIVE_TTL", "30")) # Unknown/deleted ids
+    SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", "30")) # How stale caption_mode may be
+    AD_CACHE_SIZE = int(os.getenv("AD_CACHE_SIZE", "100000")) # Users known to be inside their ad cooldown
+
+    # Write-behind buffers
+    VIEW_FLUSH_INTERVAL = float(os.getenv("VIEW_FLUSH_INTERVAL", "10")) # Seconds between view count flushes
+    VIEW_FLUSH_MAX_PENDING = int(os.getenv("VIEW_FLUSH_MAX_PENDING", "500")) # Flush early once this many anime are pending
+    USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5")) # Seconds between new user inserts
+    USER_FLUSH_MAX_PENDING = int(os.getenv("USER_FLUSH_MAX_PENDING", "1000")) # Flush early once this many users are pending
+
+    # Trending
+    TRENDING_REFRESH_SECONDS = int(os.getenv("TRENDING_REFRESH_SECONDS", "300")) # How often the top lists are rebuilt
+    TRENDING_TOP_N = int(os.getenv("TRENDING_TOP_N", "10"))
+
+    # Manual Indexing
+    INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "500")) # Upserts per bulk_write
+    INDEX_QUEUE_SIZE = int(os.getenv("INDEX_QUEUE_SIZE", "1000")) # Max items buffered between stages
+    INDEX_PROGRESS_INTERVAL = int(os.getenv("INDEX_PROGRESS_INTERVAL", "5")) # Seconds between status edits
+    SYNC_ON_STARTUP = os.getenv("SYNC_ON_STARTUP", "1") == "1" # Catch up on uploads missed while offline
+
+    # File delivery (Telegram allows bots about 30 messages/s overall and about 1/s per chat)
+    DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", "25")) # Sends per second, all chats
+    DELIVERY_CHAT_RATE = float(os.getenv("DELIVERY_CHAT_RATE", "1")) # Sends per second, per chat
+    DELIVERY_CHAT_BURST = int(os.getenv("DELIVERY_CHAT_BURST", "3"))
+    DELIVERY_MAX_PENDING = int(os.getenv("DELIVERY_MAX_PENDING", "10000")) # Queued sends before new requests are refused
+    DELIVERY_MAX_PER_CHAT = int(os.getenv("DELIVERY_MAX_PER_CHAT", "50"))
+    DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "5"))
+    DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "20")) # Sends in flight at once
+
+    # Update lanes: handlers per class of update, and how many may wait before new ones are dropped
+    LANE_INTERACTIVE_CONCURRENCY = int(os.getenv("LANE_INTERACTIVE_CONCURRENCY", "40")) # Navigation, search
+    LANE_INTERACTIVE_MAX_PENDING = int(os.getenv("LANE_INTERACTIVE_MAX_PENDING", "2000"))
+    LANE_DELIVERY_CONCURRENCY = int(os.getenv("LANE_DELIVERY_CONCURRENCY", "40")) # File Bot deep links
+    LANE_DELIVERY_MAX_PENDING = int(os.getenv("LANE_DELIVERY_MAX_PENDING", "5000"))
+    LANE_BACKGROUND_CONCURRENCY = int(os.getenv("LANE_BACKGROUND_CONCURRENCY", "4")) # /index, /sync, admin panel
+    LANE_BACKGROUND_MAX_PENDING = int(os.getenv("LANE_BACKGROUND_MAX_PENDING", "1000"))
+    # Channel uploads are never dropped (a dropped upload stays unindexed until the next /sync)
+    LANE_UPLOAD_CONCURRENCY = int(os.getenv("LANE_UPLOAD_CONCURRENCY", "4"))
+    LANE_CONTROL_CONCURRENCY = int(os.getenv("LANE_CONTROL_CONCURRENCY", "2")) # /jobs, /cancel
+    LANE_CONTROL_MAX_PENDING = int(os.getenv("LANE_CONTROL_MAX_PENDING", "100"))
+
+    # Metrics (Prometheus text format on http://METRICS_HOST:<port>/metrics; port 0 = off)
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+    INDEX_BOT_METRICS_PORT = int(os.getenv("INDEX_BOT_METRICS_PORT", "9101"))
+    FILE_BOT_METRICS_PORT = int(os.getenv("FILE_BOT_METRICS_PORT", "9102"))
@@ -1,163 +1,890 @@
+import asyncio
 import time
+import logging
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, UpdateMany, ReturnDocument, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, DuplicateKeyError, CollectionInvalid
 from config import Config
+from catalog import CatalogCache, LatestFeed, CATALOG_FIELDS, LATEST_FIELDS, library_key
+from cache import TTLCache, SingleFlight, MISSING
+from writebehind import ViewCounterBuffer, HourlyViewBuffer, NewUserBuffer
+from metrics import MongoCommandListener, instrument_methods
 
 import re
 
+logger = logging.getLogger(__name__)
+
+# Sort matching the unique file index, so a full walk is an index scan
+FILE_KEY_SORT = [("anime_name", ASCENDING), ("season", ASCENDING), ("episode", ASCENDING), ("quality", ASCENDING)]
+# Same walk keyed by the integer anime id: episode pages, catalog load, summary refresh
+ANIME_FILE_SORT = [("anime_id", ASCENDING), ("season", ASCENDING), ("episode", ASCENDING), ("quality", ASCENDING)]
+CATALOG_PROJECTION = {field: 1 for field in CATALOG_FIELDS}
+
+# Bumped when stored documents change shape; see migrate_catalog()
+CATALOG_SCHEMA = 3
+
+# Trending windows: key -> (label, hours); None = lifetime view_count
+TRENDING_WINDOWS = {
+    "24h": ("Last 24h", 24),
+    "7d": ("Last 7 days", 24 * 7),
+    "all": ("All time", None),
+}
+
+# --- INDEX REGISTRY ---
+# Every index the queries below rely on, per collection. Created by ensure_indexes() at startup;
+# `python database.py` checks that no query falls back to a collection scan.
+INDEXES = {
+    "index_cache": [
+        # save_file upsert filter, get_seasons, get_episodes (prefixes), distinct anime_name
+        IndexModel(FILE_KEY_SORT, name="anime_season_episode_quality", unique=True),
+        # get_episodes, get_season_files, load_catalog, _refresh_anime
+        IndexModel(ANIME_FILE_SORT, name="anime_id_season_episode_quality"),
+        # Shadow re-index _id carry-over
+        IndexModel([("chat_id", ASCENDING), ("message_id", ASCENDING)], name="chat_message"),
+    ],
+    "anime": [
+        # get_anime_id
+        IndexModel([("name", ASCENDING)], name="name", unique=True),
+        # Keyset pages of the library, in library_key order
+        IndexModel([("sort_key", ASCENDING)], name="sort_key"),
+    ],
+    "users": [
+        IndexModel([("user_id", ASCENDING)], name="user_id", unique=True),
+    ],
+    "favorites": [
+        # is_favorite/add/remove, and get_favorites by prefix
+        IndexModel([("user_id", ASCENDING), ("anime_id", ASCENDING)], name="user_anime_id", unique=True),
+    ],
+    "trending": [
+        IndexModel([("anime_id", ASCENDING)], name="anime_id", unique=True),
+        IndexModel([("view_count", DESCENDING)], name="view_count"),
+    ],
+    "trending_hourly": [
+        # Bucket upserts, and the window $match on hour
+        IndexModel([("hour", ASCENDING), ("anime_id", ASCENDING)], name="hour_anime_id", unique=True),
+        # Buckets are only needed for the longest window (plus a day of slack)
+        IndexModel([("bucket_at", ASCENDING)], name="bucket_ttl", expireAfterSeconds=8 * 24 * 3600),
+    ],
+    "ads_cooldown": [
+        IndexModel([("user_id", ASCENDING)], name="user_id", unique=True),
+    ],
+    "settings": [
+        IndexModel([("key", ASCENDING)], name="key", unique=True),
+    ],
+}
+
+# Indexes replaced by the ones above; dropped by ensure_indexes() once migrate_catalog() has run
+DROPPED_INDEXES = {
+    "index_cache": ["added_at"], # Latest episodes come from the latest_episodes feed now
+    "favorites": ["user_anime"],
+    "trending": ["anime_name"],
+    "trending_hourly": ["hour_anime"],
+}
+
 class Database:
     def __init__(self):
-        self.client = AsyncIOMotorClient(Config.MONGO_URI)
+        # Every command is timed per collection (metrics.MONGO_SECONDS)
+        self.client = AsyncIOMotorClient(Config.MONGO_URI, event_listeners=[MongoCommandListener()])
         self.db = self.client[Config.DB_NAME]
         
         # Collections
         self.index_cache = self.db.index_cache
+        self.anime = self.db.anime       # One document per title: integer _id, name, season summary
+        self.counters = self.db.counters # Sequences for integer ids
         self.users = self.db.users
         self.favorites = self.db.favorites
         self.trending = self.db.trending
+        self.trending_hourly = self.db.trending_hourly
+        self.trending_top = self.db.trending_top # One small pre-computed list per window
         self.ads_cooldown = self.db.ads_cooldown
         self.settings = self.db.settings
+        self.latest_episodes = self.db.latest_episodes # Capped: newly indexed files, oldest first
+        self.bot_health = self.db.bot_health # Per delivery bot: until when it is rate limited or failing
+
+        # Browse pages are served from memory once load_catalog() has run (index bot only)
+        self.catalog = CatalogCache(Config.CATALOG_MAX_FILES)
+        self._anime_ids = {} # name -> anime id, for processes without the catalog
+        self._change_listeners = [] # Called with the anime ids whose files changed (None = all)
+        self.latest = LatestFeed(Config.LATEST_FEED_SIZE) # Served from memory once load_latest() has run
+
+        # Favorite anime ids per user, for the toggle on every anime page
+        self.favorite_ids = TTLCache(Config.FAVORITES_CACHE_SIZE, Config.FAVORITES_CACHE_TTL)
+
+        # Deep link hot path: file documents by id, and settings read on every delivery
+        self.file_cache = TTLCache(Config.FILE_CACHE_SIZE, Config.FILE_CACHE_TTL)
+        self._file_flight = SingleFlight()
+        self.setting_cache = TTLCache(100, Config.SETTINGS_CACHE_TTL)
+        self.bot_health_cache = TTLCache(1, Config.BOT_HEALTH_CACHE_TTL)
+
+        # Users who saw an ad recently, until their cooldown ends; they never reach Mongo
+        self.ad_cooldowns = TTLCache(Config.AD_CACHE_SIZE, Config.AD_COOLDOWN_SECONDS)
+
+        # Every user id in `users`, loaded by load_known_users() (index bot only). Returning users
+        # cost no write and the total is len(); ~100 bytes per user.
+        self.known_users = None
+        self.new_users = NewUserBuffer(self.users, Config.USER_FLUSH_INTERVAL, Config.USER_FLUSH_MAX_PENDING)
+
+        # View counts are buffered and flushed in bulk, off the click path
+        self.view_counter = ViewCounterBuffer(self.trending, Config.VIEW_FLUSH_INTERVAL, Config.VIEW_FLUSH_MAX_PENDING)
+        self.hourly_views = HourlyViewBuffer(self.trending_hourly, Config.VIEW_FLUSH_INTERVAL, Config.VIEW_FLUSH_MAX_PENDING)
+
+        # Re-index target while /index is running (see begin_shadow_index)
+        self.shadow_index = None
+        self._shadow_ids = {}
+        self._shadow_new = [] # Latest Episodes entries for files the crawl found for the first time
+        self._swap_lock = asyncio.Lock() # Held by commit_shadow_index() for the rename
+        self._swapping = False
+
+    # --- LIFECYCLE ---
+    def start(self):
+        # Background flushers; needs the running event loop
+        self.view_counter.start()
+        self.hourly_views.start()
+        self.new_users.start()
+
+    async def close(self):
+        # Flush whatever is still buffered before the process exits
+        await self.view_counter.stop()
+        await self.hourly_views.stop()
+        await self.new_users.stop()
+
+    def add_change_listener(self, callback):
+        # callback(anime_ids) after files are saved or deleted; anime_ids None = everything
+        self._change_listeners.append(callback)
+
+    def _notify_change(self, anime_ids=None):
+        for callback in self._change_listeners:
+            callback(anime_ids)
+
+    # --- INDEXES ---
+    async def ensure_indexes(self):
+        for name in INDEXES:
+            await self._create_indexes(self.db[name], name)
+        await self._ensure_latest_feed()
+        for name, index_names in DROPPED_INDEXES.items():
+            existing = await self.db[name].index_information()
+            for index_name in index_names:
+                if index_name in existing:
+                    await self.db[name].drop_index(index_name)
+
+    async def _create_indexes(self, collection, name):
+        try:
+            await collection.create_indexes(INDEXES[name])
+        except OperationFailure as e:
+            # e.g. duplicates blocking a unique index; keep running on what exists
+            logger.error(f"Index creation failed on {collection.name}: {e}")
+
+    async def _ensure_latest_feed(self):
+        # Capped collection behind Latest Episodes; the first time, seeded from index_cache
+        try:
+            await self.db.create_collection(
+                self.latest_episodes.name, capped=True,
+                size=max(1 << 20, Config.LATEST_FEED_SIZE * 1024), max=Config.LATEST_FEED_SIZE
+            )
+        except CollectionInvalid:
+            return # Already there
+        cursor = self.index_cache.find({}, {field: 1 for field in LATEST_FIELDS if field != "file_id"})
+        newest = await cursor.sort("added_at", -1).limit(Config.LATEST_FEED_SIZE).to_list(length=None)
+        if newest:
+            await self.latest_episodes.insert_many([_latest_entry(doc) for doc in reversed(newest)])
+
+    def _planned_queries(self):
+        # (method, command, full_scan_ok) for every query shape Database issues.
+        # Sample values only matter for the plan, not the result.
+        key = self._file_key({"anime_name": "Naruto", "season": 1, "episode": 1, "quality": "720p"})
+        user = {"user_id": 1}
+        user_anime = {"user_id": 1, "anime_id": 1}
+        listed = {"file_count": {"$gt": 0}}
+        return [
+            ("save_file", {"find": "index_cache", "filter": key}, False),
+            ("get_anime_id", {"find": "anime", "filter": {"name": "Naruto"}}, False),
+            ("get_anime", {"find": "anime", "filter": {"_id": 1}}, False),
+            ("get_anime_list", {"distinct": "anime", "key": "name", "query": listed}, True),
+            ("get_anime_page", {"find": "anime", "filter": dict(listed, sort_key={"$gte": "n"}), "sort": {"sort_key": 1}, "limit": 21}, False),
+            ("get_anime_page", {"find": "anime", "filter": dict(listed, sort_key={"$lt": "n"}), "sort": {"sort_key": -1}, "limit": 21}, False),
+            ("search_anime", {"find": "anime", "filter": dict(listed, name={"$regex": "naru", "$options": "i"}), "limit": 50}, False),
+            ("get_episodes", {"find": "index_cache", "filter": {"anime_id": 1, "season": 1}, "sort": {"episode": 1}}, False),
+            ("get_season_files", {"find": "index_cache", "filter": {"anime_id": 1, "season": 1, "quality": "720p"}, "sort": {"episode": 1}}, False),
+            ("_refresh_anime", {"aggregate": "index_cache", "pipeline": self._summary_pipeline([1]), "cursor": {}}, False),
+            ("load_catalog", {"find": "anime", "filter": {}}, True),
+            ("load_catalog", {"find": "index_cache", "filter": {}, "projection": CATALOG_PROJECTION, "sort": dict(ANIME_FILE_SORT)}, False),
+            ("get_latest", {"find": "latest_episodes", "filter": {}, "sort": {"$natural": -1}, "skip": 10, "limit": 11}, True),
+            ("begin_shadow_index", {"find": "index_cache", "filter": {}, "projection": {"chat_id": 1, "message_id": 1}}, True),
+            ("get_last_message_id", {"find": "index_cache", "filter": {"chat_id": -1001}, "sort": {"message_id": -1}, "limit": 1}, False),
+            ("add_user", {"find": "users", "filter": user}, False),
+            ("load_known_users", {"find": "users", "filter": {}, "projection": {"_id": 0, "user_id": 1}, "hint": "user_id"}, False),
+            ("increase_view", {"find": "trending", "filter": {"anime_id": 1}}, False),
+            ("get_trending", {"find": "trending_top", "filter": {"_id": "24h"}}, False),
+            ("materialize_trending", {"find": "trending", "filter": {}, "sort": {"view_count": -1}, "limit": 10}, False),
+            ("materialize_trending", {"aggregate": "trending_hourly", "pipeline": self._window_pipeline(24, 10), "cursor": {}}, False),
+            ("add_favorite", {"find": "favorites", "filter": user_anime}, False),
+            ("get_favorite_ids", {"find": "favorites", "filter": user, "projection": {"_id": 0, "anime_id": 1}}, False),
+            ("get_favorites", {"find": "favorites", "filter": user}, False),
+            ("get_setting", {"find": "settings", "filter": {"key": "caption_mode"}}, False),
+            ("claim_ad_slot", {"find": "ads_cooldown", "filter": user}, False),
+            ("get_flooded_bots", {"find": "bot_health", "filter": {}}, True),
+        ]
+
+    async def verify_query_plans(self):
+        # Runs explain() on every planned query. Returns [(method, stages, ok)]
+        results = []
+        for method, command, full_scan_ok in self._planned_queries():
+            explain = await self.db.command({"explain": command, "verbosity": "queryPlanner"})
+            stages = [stage for plan in _winning_plans(explain) for stage in _plan_stages(plan)]
+            results.append((method, stages, full_scan_ok or "COLLSCAN" not in stages))
+        return results
 
     # --- INDEX CACHE ---
+    @staticmethod
+    def _file_key(file_data):
+        # One document per anime/season/episode/quality
+        return {
+            "anime_name": file_data["anime_name"],
+            "season": file_data["season"],
+            "episode": file_data["episode"],
+            "quality": file_data["quality"]
+        }
+
     async def save_file(self, file_data):
-        # file_data: anime_name, season, episode, quality, audio, message_id, channel_id, file_unique_id
-        file_data['added_at'] = time.time()
-        file_data['is_new'] = True
+        # file_data: anime_name, season, episode, quality, audio, message_id, chat_id and the media
+        # metadata from parse_message (file_id, file_unique_id, file_size, mime_type, duration, caption)
+        now = time.time()
+        file_data['anime_id'] = await self.get_anime_id(file_data['anime_name'])
+        shadow = self.shadow_index
         
-        # Update if exists (same file/quality) or insert
-        await self.index_cache.update_one(
-            {
-                "anime_name": file_data["anime_name"],
-                "season": file_data["season"],
-                "episode": file_data["episode"],
-                "quality": file_data["quality"]
-            },
-            {"$set": file_data},
-            upsert=True
+        # Update if exists (same file/quality) or insert.
+        # added_at is when the episode was first indexed: a re-upload doesn't make it new again.
+        doc = await self.index_cache.find_one_and_update(
+            self._file_key(file_data),
+            {"$set": file_data, "$setOnInsert": {"added_at": now, "is_new": True}},
+            projection=CATALOG_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
         )
+        if self.catalog.loaded:
+            self.catalog.add_file(doc)
+        self.file_cache.pop(str(doc["_id"]))
+
+        if shadow is not None:
+            # A re-index is running: mirror into the shadow with the same _id,
+            # otherwise uploads made during the crawl would vanish at the swap
+            mirror = {"$set": file_data, "$setOnInsert": {"_id": doc["_id"], "added_at": doc["added_at"], "is_new": True}}
+            await shadow.update_one(self._file_key(file_data), mirror, upsert=True)
+            if self._swapping or self.shadow_index is not shadow:
+                # The swap ran meanwhile: either write may have hit a collection the rename replaced.
+                # Write again once it is over.
+                async with self._swap_lock:
+                    await self.index_cache.update_one(self._file_key(file_data), mirror, upsert=True)
+        if doc.get("added_at") == now:
+            # Inserted by this call
+            await self._push_latest([_latest_entry(doc)])
+        await self._refresh_anime([file_data['anime_id']])
+
+    async def save_files(self, files, shadow=False):
+        # Batched save_file for the re-index pipeline: one round trip per batch
+        if not files:
+            return None
+        now = time.time()
+        ops = []
+        known = [] # Per file: already indexed before this re-index
+        for file_data in files:
+            file_data['anime_id'] = await self.get_anime_id(file_data['anime_name'])
+            first_seen = {"added_at": now, "is_new": True}
+            if shadow:
+                # Keep the _id (and so the deep link), first-seen time and file_ids of files that
+                # were already indexed
+                old = self._shadow_ids.get((file_data.get("chat_id"), file_data.get("message_id")))
+                if old is not None:
+                    old_id, file_ids, added_at = old
+                    first_seen.update(_id=old_id, added_at=added_at or now)
+                    if file_ids:
+                        first_seen["file_ids"] = file_ids
+                known.append(old is not None)
+            ops.append(UpdateOne(self._file_key(file_data), {"$set": file_data, "$setOnInsert": first_seen}, upsert=True))
+        # Unordered so one bad document doesn't stop the rest of the batch
+        if shadow:
+            # Summaries are rebuilt once, at commit; new files join Latest Episodes then too
+            result = await self.shadow_index.bulk_write(ops, ordered=False)
+            self._shadow_new += [
+                (files[i].get("message_id", 0), _latest_entry(dict(files[i], _id=_id, added_at=now)))
+                for i, _id in result.upserted_ids.items() if not known[i]
+            ]
+            return result
+
+        result = await self.index_cache.bulk_write(ops, ordered=False)
+        # Crawls walk history newest first; the feed takes oldest first
+        upserted = sorted(result.upserted_ids.items(), key=lambda item: files[item[0]].get("message_id", 0))
+        await self._push_latest([_latest_entry(dict(files[i], _id=_id, added_at=now)) for i, _id in upserted])
+        anime_ids = {file_data["anime_id"] for file_data in files}
+        if self.catalog.loaded:
+            # Upserts don't return the documents; reload touched anime on next view
+            for anime_id in anime_ids:
+                self.catalog.invalidate(anime_id)
+        await self._refresh_anime(anime_ids)
+        return result
+
+    # --- SHADOW RE-INDEX ---
+    # /index builds a fresh copy next to the live collection and swaps it in at the end,
+    # so users keep browsing the old catalog for the whole crawl.
+    async def begin_shadow_index(self):
+        shadow = self.db[self.index_cache.name + "_shadow"]
+        await shadow.drop() # Leftover from an interrupted run
+        # The unique file key up front: channels are crawled concurrently, and without it two of them
+        # upserting the same episode at once would both insert. The other indexes are built at commit.
+        await shadow.create_indexes([INDEXES["index_cache"][0]])
+
+        # Per channel message: its _id, the file_ids the delivering bots recorded and when it was
+        # first indexed
+        ids = {}
+        async for doc in self.index_cache.find({}, {"chat_id": 1, "message_id": 1, "file_ids": 1, "added_at": 1}):
+            if "message_id" in doc:
+                ids[(doc.get("chat_id"), doc["message_id"])] = (doc["_id"], doc.get("file_ids"), doc.get("added_at"))
+
+        self._shadow_ids = ids
+        self._shadow_new = []
+        self.shadow_index = shadow
+
+    async def commit_shadow_index(self):
+        # renameCollection with dropTarget replaces index_cache in one step.
+        # Indexes are built on the shadow first since the rename keeps the source's indexes.
+        # Uploads keep being mirrored into the shadow until the rename is done.
+        shadow = self.shadow_index
+        await self._create_indexes(shadow, "index_cache")
+        async with self._swap_lock:
+            self._swapping = True
+            try:
+                await shadow.rename(self.index_cache.name, dropTarget=True)
+            finally:
+                self._swapping = False
+                self.shadow_index, self._shadow_ids = None, {}
+        new_files, self._shadow_new = self._shadow_new, []
+        self.file_cache.clear()
+        await self._refresh_anime()
+        if self.catalog.loaded:
+            await self.load_catalog()
+        # (message_id, entry) pairs, collected newest first; the feed takes oldest first
+        await self._push_latest([entry for _, entry in sorted(new_files, key=lambda pair: pair[0])])
+        if self.latest.loaded:
+            # Files that are gone from the channels leave the feed
+            listed = list(self.latest.file_ids())
+            present = {doc["_id"] async for doc in self.index_cache.find({"_id": {"$in": listed}}, {"_id": 1})}
+            self.latest.remove(set(listed) - present)
+
+    async def abort_shadow_index(self):
+        shadow, self.shadow_index, self._shadow_ids = self.shadow_index, None, {}
+        self._shadow_new = []
+        if shadow is not None:
+            await shadow.drop()
+
+    # --- ANIME IDS ---
+    # Every title gets a small integer id (anime._id). Callback data carries the id instead of the
+    # name, which keeps buttons within Telegram's 64 byte limit whatever the title length.
+    async def get_anime_id(self, anime_name, create=True):
+        anime_id = self.catalog.anime_id(anime_name) or self._anime_ids.get(anime_name)
+        if anime_id is not None:
+            return anime_id
+        doc = await self.anime.find_one({"name": anime_name})
+        if doc is None:
+            if not create:
+                return None
+            counter = await self.counters.find_one_and_update(
+                {"_id": "anime_id"},
+                {"$inc": {"seq": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            doc = {"_id": counter["seq"], "name": anime_name, "sort_key": library_key(anime_name), "seasons": [], "file_count": 0, "episode_count": 0, "updated_at": time.time()}
+            try:
+                await self.anime.insert_one(doc)
+            except DuplicateKeyError:
+                # Registered concurrently; the stored id wins and ours is skipped
+                doc = await self.anime.find_one({"name": anime_name})
+        if self.catalog.loaded and self.catalog.anime_id(anime_name) is None:
+            self.catalog.set_anime(doc)
+        self._anime_ids[anime_name] = doc["_id"]
+        return doc["_id"]
+
+    @staticmethod
+    def _summary_pipeline(anime_ids=None):
+        # Per anime: its seasons with episode and file counts
+        match = {} if anime_ids is None else {"anime_id": {"$in": list(anime_ids)}}
+        return [
+            {"$match": match},
+            {"$group": {
+                "_id": {"anime_id": "$anime_id", "season": "$season"},
+                "episodes": {"$addToSet": "$episode"},
+                "files": {"$sum": 1}
+            }},
+            {"$group": {
+                "_id": "$_id.anime_id",
+                "seasons": {"$push": {"season": "$_id.season", "episodes": {"$size": "$episodes"}, "files": "$files"}},
+                "file_count": {"$sum": "$files"},
+                "episode_count": {"$sum": {"$size": "$episodes"}}
+            }}
+        ]
+
+    async def _refresh_anime(self, anime_ids=None):
+        # Recompute the denormalized summaries of the given anime (None = all of them).
+        # Anime left without files keep their id with file_count 0, so old buttons still resolve.
+        if anime_ids is not None:
+            anime_ids = list(anime_ids)
+            if not anime_ids:
+                return
+        now = time.time()
+        summaries = {}
+        async for doc in self.index_cache.aggregate(self._summary_pipeline(anime_ids)):
+            summaries[doc["_id"]] = {
+                "seasons": sorted(doc["seasons"], key=lambda s: s["season"]),
+                "file_count": doc["file_count"],
+                "episode_count": doc["episode_count"],
+                "updated_at": now
+            }
+        empty = {"seasons": [], "file_count": 0, "episode_count": 0, "updated_at": now}
+
+        ops = [UpdateOne({"_id": anime_id}, {"$set": summary}) for anime_id, summary in summaries.items()]
+        if anime_ids is None:
+            ops.append(UpdateMany({"_id": {"$nin": list(summaries)}}, {"$set": empty}))
+        else:
+            ops += [UpdateOne({"_id": anime_id}, {"$set": empty}) for anime_id in anime_ids if anime_id not in summaries]
+        await self.anime.bulk_write(ops, ordered=False)
+
+        if self.catalog.loaded and anime_ids is not None:
+            # A full refresh is followed by load_catalog() instead
+            for anime_id in anime_ids:
+                self.catalog.update_anime(anime_id, summaries.get(anime_id, empty))
+        self._notify_change(anime_ids)
+
+    async def migrate_catalog(self):
+        # One-off move from name keyed documents to anime ids; safe to re-run.
+        # Must run before ensure_indexes(): the new unique indexes need anime_id filled in.
+        schema = await self.get_setting("catalog_schema", 1)
+        if schema >= CATALOG_SCHEMA:
+            return
+        if schema == 2:
+            await self._backfill_sort_keys()
+            await self.set_setting("catalog_schema", CATALOG_SCHEMA)
+            return
+        logger.info("Migrating catalog to anime ids...")
+        await self._create_indexes(self.anime, "anime")
+        names = set()
+        for collection in (self.index_cache, self.favorites, self.trending):
+            names.update(name for name in await collection.distinct("anime_name") if name)
+        for name in names:
+            anime_id = await self.get_anime_id(name)
+            missing = {"anime_name": name, "anime_id": {"$exists": False}}
+            for collection in (self.index_cache, self.favorites, self.trending, self.trending_hourly):
+                await collection.update_many(missing, {"$set": {"anime_id": anime_id}})
+        await self._refresh_anime()
+        await self._backfill_sort_keys()
+        await self.set_setting("catalog_schema", CATALOG_SCHEMA)
+        logger.info(f"Catalog migrated: {len(names)} anime")
+
+    async def _backfill_sort_keys(self):
+        # Schema 3: library_key() stored as sort_key. Computed here rather than with $toLower,
+        # which only lowercases ASCII and would disagree with the in-memory order.
+        ops = [
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"sort_key": library_key(doc["name"])}})
+            async for doc in self.anime.find({"sort_key": {"$exists": False}}, {"name": 1})
+        ]
+        if ops:
+            await self.anime.bulk_write(ops, ordered=False)
+        logger.info(f"Library sort keys added to {len(ops)} anime")
+
+    # --- CATALOG ---
+    async def load_catalog(self):
+        # Every anime summary, then file trees in id order, one anime at a time.
+        # Past CATALOG_MAX_FILES the rest is left to load on demand.
+        self.catalog.reset(await self.anime.find({}).to_list(length=None))
+        cursor = self.index_cache.find({}, CATALOG_PROJECTION).sort(ANIME_FILE_SORT)
+        current, docs = None, []
+        async for doc in cursor:
+            if doc["anime_id"] != current:
+                if docs:
+                    if not self.catalog.has_room(len(docs)):
+                        break
+                    self.catalog.put_files(current, docs)
+                current, docs = doc["anime_id"], []
+            docs.append(doc)
+        else:
+            if docs and self.catalog.has_room(len(docs)):
+                self.catalog.put_files(current, docs)
+        self._notify_change()
+        stats = self.catalog.stats()
+        logger.info(f"Catalog loaded: {stats['anime']} anime, {stats['cached_files']} files in memory")
+
+    async def _load_anime(self, anime_id):
+        cursor = self.index_cache.find({"anime_id": anime_id}, CATALOG_PROJECTION)
+        self.catalog.put_files(anime_id, await cursor.to_list(length=None))
+
+    async def get_anime(self, anime_id):
+        # {_id, name, seasons: [{season, episodes, files}], file_count, episode_count}
+        if self.catalog.loaded:
+            return self.catalog.get_anime(anime_id)
+        return await self.anime.find_one({"_id": anime_id})
+
+    async def get_anime_by_name(self, anime_name):
+        anime_id = await self.get_anime_id(anime_name, create=False)
+        return None if anime_id is None else await self.get_anime(anime_id)
 
     async def get_anime_list(self):
-        return await self.index_cache.distinct("anime_name")
+        if self.catalog.loaded:
+            return self.catalog.anime_names()
+        return await self.anime.distinct("name", {"file_count": {"$gt": 0}})
+
+    async def get_anime_page(self, start=None, before=None, limit=20):
+        # Keyset page of the library in library_key order: (anime docs, has_prev, has_next).
+        # start/before are library keys.
+        # Served by bisect on the in-memory name list; the query fallback is only for
+        # processes that never load the catalog.
+        if self.catalog.loaded:
+            return self.catalog.anime_page(start, before, limit)
+        listed = {"file_count": {"$gt": 0}}
+        if before is not None:
+            cursor = self.anime.find(dict(listed, sort_key={"$lt": before})).sort("sort_key", -1).limit(limit + 1)
+            docs = await cursor.to_list(length=limit + 1)
+            # `before` itself is the next page
+            return docs[:limit][::-1], len(docs) > limit, True
+        cursor = self.anime.find(dict(listed, sort_key={"$gte": start or ""})).sort("sort_key", 1).limit(limit + 1)
+        docs = await cursor.to_list(length=limit + 1)
+        has_prev = bool(start) and await self.anime.find_one(dict(listed, sort_key={"$lt": start}), {"_id": 1}) is not None
+        return docs[:limit], has_prev, len(docs) > limit
 
     async def search_anime(self, query):
-        # Regex search for anime name
+        if self.catalog.loaded:
+            # Token/n-gram index in memory: prefix and typo tolerant, ranked
+            return self.catalog.search_anime(query, limit=50)
+
         # Escape special characters to prevent regex errors (e.g. unmatched parenthesis)
-        escaped_query = re.escape(query)
-        regex = {"$regex": escaped_query, "$options": "i"}
-
-        cursor = self.index_cache.find({"anime_name": regex})
-        # Distinct is tricky with find, so we aggregate or just python set
-        # Using aggregation for cleaner distinct + match
-        pipeline = [
-            {"$match": {"anime_name": regex}},
-            {"$group": {"_id": "$anime_name"}},
-            {"$limit": 50}
-        ]
-        results = []
-        async for doc in self.index_cache.aggregate(pipeline):
-            results.append(doc["_id"])
-        return results
+        regex = {"$regex": re.escape(query), "$options": "i"}
+        cursor = self.anime.find({"name": regex, "file_count": {"$gt": 0}}).limit(50)
+        return await cursor.to_list(length=50)
 
-    async def get_seasons(self, anime_name):
-        return await self.index_cache.find({"anime_name": anime_name}).distinct("season")
+    async def get_seasons(self, anime_id):
+        anime = await self.get_anime(anime_id)
+        return [season["season"] for season in anime["seasons"]] if anime else []
 
-    async def get_episodes(self, anime_name, season):
+    async def get_episodes(self, anime_id, season):
+        if self.catalog.loaded:
+            episodes = self.catalog.episodes(anime_id, season)
+            if episodes is None:
+                await self._load_anime(anime_id)
+                episodes = self.catalog.episodes(anime_id, season)
+            return episodes
         cursor = self.index_cache.find({
-            "anime_name": anime_name,
+            "anime_id": anime_id,
             "season": season
         }).sort("episode", 1)
         return await cursor.to_list(length=None)
+
+    async def get_season_files(self, anime_id, season, quality):
+        # Full documents (with file_ids) for a season download, in episode order
+        cursor = self.index_cache.find({
+            "anime_id": anime_id,
+            "season": season,
+            "quality": quality
+        }).sort("episode", 1)
+        return await cursor.to_list(length=None)
+
+    # --- LATEST EPISODES ---
+    async def load_latest(self):
+        # Capped collections keep insertion order: newest first without a sort
+        cursor = self.latest_episodes.find({}, {"_id": 0}).sort("$natural", -1).limit(Config.LATEST_FEED_SIZE)
+        self.latest.reset(await cursor.to_list(length=None))
+
+    async def get_latest(self, page=0, limit=10):
+        # (entries, has_next), newest first
+        if self.latest.loaded:
+            return self.latest.page(page, limit)
+        cursor = self.latest_episodes.find({}, {"_id": 0}).sort("$natural", -1).skip(page * limit).limit(limit + 1)
+        entries = await cursor.to_list(length=limit + 1)
+        return entries[:limit], len(entries) > limit
+
+    async def _push_latest(self, entries):
+        # entries oldest first. The feed is best effort: a failed write never fails the indexing
+        if not entries:
+            return
+        self.latest.push(entries)
+        try:
+            await self.latest_episodes.insert_many([dict(entry) for entry in entries], ordered=False)
+        except Exception as e:
+            logger.error(f"Latest episodes write failed: {e}")
+
+    async def get_last_message_id(self, chat_id):
+        # Newest message of the channel that is in the index (0 = none)
+        doc = await self.index_cache.find_one({"chat_id": chat_id}, {"message_id": 1}, sort=[("message_id", DESCENDING)])
+        return doc["message_id"] if doc else 0
+
+    async def get_total_files(self):
+        # Collection metadata, no scan
+        return await self.index_cache.estimated_document_count()
         
     async def get_file(self, file_id_str):
         # We might need to store a unique ID reference for the deep link
         # Prompt implies browsing. deep link probably sends a unique ID (like ObjectId hex)
         # Let's assume we pass the Object ID
+        # Cached (LRU + TTL); concurrent misses for the same id share one query
+        doc = self.file_cache.get(file_id_str)
+        if doc is not MISSING:
+            return doc
+        return await self._file_flight.do(file_id_str, lambda: self._load_file(file_id_str))
+
+    async def _load_file(self, file_id_str):
         from bson.objectid import ObjectId
         try:
-            return await self.index_cache.find_one({"_id": ObjectId(file_id_str)})
+            doc = await self.index_cache.find_one({"_id": ObjectId(file_id_str)})
         except:
             return None
+        # Unknown ids are remembered too, for less time
+        self.file_cache.set(file_id_str, doc, None if doc else Config.FILE_CACHE_NEGATIVE_TTL)
+        return doc
     
+    async def set_bot_file_id(self, file_doc, bot_id, media):
+        # file_ids are per bot: the delivering bot records its own after the first copy, keyed
+        # by its id. file_unique_id tells whether it still belongs to the indexed file.
+        entry = {"file_id": media.file_id, "file_unique_id": media.file_unique_id}
+        await self.index_cache.update_one({"_id": file_doc["_id"]}, {"$set": {f"file_ids.{bot_id}": entry}})
+        # The cached document is updated in place
+        file_doc.setdefault("file_ids", {})[str(bot_id)] = entry
+
     async def delete_file(self, file_id):
          from bson.objectid import ObjectId
-         await self.index_cache.delete_one({"_id": ObjectId(file_id)})
+         doc = await self.index_cache.find_one_and_delete({"_id": ObjectId(file_id)}, projection=CATALOG_PROJECTION)
+         self.file_cache.pop(str(file_id))
+         if doc:
+             if self.catalog.loaded:
+                 self.catalog.remove_file(doc)
+             self.latest.remove([doc["_id"]])
+             await self._refresh_anime([doc["anime_id"]])
          
     async def clear_index(self):
         await self.index_cache.delete_many({})
+        self.file_cache.clear()
+        # Capped collections can't be emptied with delete_many
+        await self.latest_episodes.drop()
+        await self._ensure_latest_feed()
+        if self.latest.loaded:
+            self.latest.reset([])
+        await self._refresh_anime()
+        if self.catalog.loaded:
+            await self.load_catalog()
 
     # --- USERS ---
+    async def load_known_users(self):
+        # Covered scan of the user_id index: no documents are read
+        cursor = self.users.find({}, {"_id": 0, "user_id": 1}).hint("user_id")
+        self.known_users = {doc["user_id"] async for doc in cursor}
+        logger.info(f"Known users loaded: {len(self.known_users)}")
+
     async def add_user(self, user_id, first_name, username):
-        await self.users.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "first_name": first_name,
-                "username": username,
-                "joined_at": time.time()
-             }},
-            upsert=True
-        )
+        # Only a user's first /start is written, and that is buffered (see NewUserBuffer)
+        if self.known_users is not None:
+            if user_id in self.known_users:
+                return
+            self.known_users.add(user_id)
+        self.new_users.register(user_id, first_name, username)
         
     async def is_user_exist(self, user_id):
         return await self.users.find_one({"user_id": user_id})
 
     async def get_total_users(self):
-        return await self.users.count_documents({})
+        if self.known_users is not None:
+            return len(self.known_users)
+        # Collection metadata, no scan
+        return await self.users.estimated_document_count()
 
-    # --- TRENDING ---
-    async def increase_view(self, anime_name):
-        await self.trending.update_one(
-            {"anime_name": anime_name},
-            {"$inc": {"view_count": 1}},
+    # --- DELIVERY BOT HEALTH ---
+    async def report_bot_unhealthy(self, username, seconds):
+        # Written by the file bot that is rate limited or failing, read by the index bot
+        await self.bot_health.update_one(
+            {"_id": username},
+            {"$max": {"flood_until": time.time() + seconds}, "$inc": {"reports": 1}},
             upsert=True
         )
 
-    async def get_trending(self, limit=10):
-        cursor = self.trending.find().sort("view_count", -1).limit(limit)
-        return await cursor.to_list(length=limit)
+    async def get_flooded_bots(self):
+        # Usernames of delivery bots reported unhealthy right now; re-read every BOT_HEALTH_CACHE_TTL
+        flood_until = self.bot_health_cache.get("bots")
+        if flood_until is MISSING:
+            flood_until = {doc["_id"]: doc.get("flood_until", 0) async for doc in self.bot_health.find({})}
+            self.bot_health_cache.set("bots", flood_until)
+        now = time.time()
+        return {username for username, until in flood_until.items() if until > now}
+
+    # --- TRENDING ---
+    async def increase_view(self, anime_id, anime_name):
+        # Buffered; reaches trending and its hourly bucket on the next flush
+        self.view_counter.incr(anime_id, anime_name)
+        self.hourly_views.incr(anime_id, anime_name)
+
+    @staticmethod
+    def _window_pipeline(hours, limit):
+        since = int(time.time() // 3600) - hours + 1
+        return [
+            {"$match": {"hour": {"$gte": since}}},
+            {"$group": {"_id": "$anime_id", "anime_name": {"$last": "$anime_name"}, "view_count": {"$sum": "$views"}}},
+            {"$sort": {"view_count": -1, "_id": 1}},
+            {"$limit": limit}
+        ]
+
+    async def _compute_trending(self, window, limit):
+        hours = TRENDING_WINDOWS[window][1]
+        if hours is None:
+            cursor = self.trending.find({}, {"_id": 0, "anime_id": 1, "anime_name": 1, "view_count": 1}).sort("view_count", -1).limit(limit)
+            return await cursor.to_list(length=limit)
+        items = []
+        async for doc in self.trending_hourly.aggregate(self._window_pipeline(hours, limit)):
+            items.append({"anime_id": doc["_id"], "anime_name": doc["anime_name"], "view_count": doc["view_count"]})
+        return items
+
+    async def materialize_trending(self, limit=None):
+        # Background job: rebuild the top-N of every window into trending_top
+        limit = limit or Config.TRENDING_TOP_N
+        for window in TRENDING_WINDOWS:
+            items = await self._compute_trending(window, limit)
+            await self.trending_top.replace_one(
+                {"_id": window},
+                {"items": items, "updated_at": time.time()},
+                upsert=True
+            )
+
+    async def get_trending(self, window="24h", limit=10):
+        # Single _id lookup on the materialized list
+        doc = await self.trending_top.find_one({"_id": window})
+        if doc is None:
+            # Not materialized yet (fresh database)
+            return await self._compute_trending(window, limit)
+        return doc["items"][:limit]
 
     # --- FAVORITES ---
-    async def add_favorite(self, user_id, anime_name):
+    async def add_favorite(self, user_id, anime_id, anime_name):
+        # anime_name is kept for display only
         await self.favorites.update_one(
-            {"user_id": user_id, "anime_name": anime_name},
-            {"$set": {"added_at": time.time()}},
+            {"user_id": user_id, "anime_id": anime_id},
+            {"$set": {"anime_name": anime_name, "added_at": time.time()}},
             upsert=True
         )
+        cached = self.favorite_ids.get(user_id)
+        if cached is not MISSING:
+            cached.add(anime_id)
 
-    async def remove_favorite(self, user_id, anime_name):
-        await self.favorites.delete_one({"user_id": user_id, "anime_name": anime_name})
+    async def remove_favorite(self, user_id, anime_id):
+        await self.favorites.delete_one({"user_id": user_id, "anime_id": anime_id})
+        cached = self.favorite_ids.get(user_id)
+        if cached is not MISSING:
+            cached.discard(anime_id)
 
     async def get_favorites(self, user_id):
         cursor = self.favorites.find({"user_id": user_id})
         return await cursor.to_list(length=None)
 
-    async def is_favorite(self, user_id, anime_name):
-        return await self.favorites.find_one({"user_id": user_id, "anime_name": anime_name})
+    async def get_favorite_ids(self, user_id):
+        # One query per user per FAVORITES_CACHE_TTL, then answered from memory
+        ids = self.favorite_ids.get(user_id)
+        if ids is MISSING:
+            cursor = self.favorites.find({"user_id": user_id}, {"_id": 0, "anime_id": 1})
+            ids = {doc["anime_id"] for doc in await cursor.to_list(length=None)}
+            self.favorite_ids.set(user_id, ids)
+        return ids
+
+    async def is_favorite(self, user_id, anime_id):
+        return anime_id in await self.get_favorite_ids(user_id)
 
     # --- SETTINGS & ADS ---
     async def get_setting(self, key, default=None):
         doc = await self.settings.find_one({"key": key})
         return doc["value"] if doc else default
 
+    async def get_cached_setting(self, key, default=None):
+        # For settings read on every request (caption_mode): kept in memory and re-read every
+        # SETTINGS_CACHE_TTL seconds, since the other bot may change them
+        value = self.setting_cache.get(key)
+        if value is MISSING:
+            doc = await self.settings.find_one({"key": key})
+            value = doc["value"] if doc else None
+            self.setting_cache.set(key, value)
+        return default if value is None else value
+
     async def set_setting(self, key, value):
         await self.settings.update_one(
             {"key": key},
             {"$set": {"value": value}},
             upsert=True
         )
+        self.setting_cache.set(key, value)
+
+    async def claim_ad_slot(self, user_id, cooldown_seconds=None):
+        # True = show the ad now; the impression is recorded by the same operation.
+        # The cooldown check and the write are one atomic update, so of several concurrent
+        # taps (or both bots) exactly one wins.
+        if cooldown_seconds is None:
+            cooldown_seconds = Config.AD_COOLDOWN_SECONDS
+        if self.ad_cooldowns.get(user_id) is not MISSING:
+            return False
 
-    async def check_ad_cooldown(self, user_id, cooldown_seconds=3600):
-        doc = await self.ads_cooldown.find_one({"user_id": user_id})
-        current_time = time.time()
-        if not doc:
-            return True # Show ad
-        if current_time - doc["last_ad_time"] > cooldown_seconds:
-            return True
-        return False
-
-    async def update_ad_time(self, user_id):
-        await self.ads_cooldown.update_one(
+        now = time.time()
+        cutoff = now - cooldown_seconds
+        # The document as it was before this update decides: the taps after the winner see its time
+        before = await self.ads_cooldown.find_one_and_update(
             {"user_id": user_id},
-            {"$set": {"last_ad_time": time.time()}},
-            upsert=True
+            [{"$set": {"last_ad_time": {"$cond": [
+                {"$gt": [{"$ifNull": ["$last_ad_time", 0]}, cutoff]},
+                "$last_ad_time", # Still cooling down: unchanged
+                now
+            ]}}}],
+            projection={"_id": 0, "last_ad_time": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
         )
+        claimed = before is None or before.get("last_ad_time", 0) <= cutoff
+        last_ad_time = now if claimed else before["last_ad_time"]
+        remaining = last_ad_time + cooldown_seconds - now
+        if remaining > 0:
+            self.ad_cooldowns.set(user_id, True, ttl=remaining)
+        return claimed
+
+def _latest_entry(file_doc):
+    # Latest Episodes entry for an index_cache document
+    entry = {field: file_doc.get(field) for field in LATEST_FIELDS}
+    entry["file_id"] = file_doc["_id"]
+    return entry
+
+def _winning_plans(explain):
+    # find/distinct explain has queryPlanner at the top, aggregate may nest it under stages[].$cursor
+    if isinstance(explain, dict):
+        if "winningPlan" in explain:
+            yield explain["winningPlan"]
+            return
+        for value in explain.values():
+            yield from _winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from _winning_plans(value)
+
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+# Latency and errors of every public method, cache hits included (metrics.DB_SECONDS)
+instrument_methods(Database)
 
 db = Database()
+
+if __name__ == "__main__":
+    # python database.py: create indexes, then fail if any query plan is a COLLSCAN
+    import sys
+
+    async def verify():
+        await db.ensure_indexes()
+        failed = 0
+        for method, stages, ok in await db.verify_query_plans():
+            print(f"{'OK  ' if ok else 'FAIL'} {method}: {' > '.join(stages)}")
+            failed += not ok
+        return 1 if failed else 0
+
+    sys.exit(asyncio.get_event_loop().run_until_complete(verify()))
@@ -0,0 +1,333 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import time
+from collections import deque
+from pyrogram.errors import FloodWait, BadRequest, Forbidden, Unauthorized
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # `rate` sends per second, up to `burst` at once.
+    # A send costing more than `burst` (a media group) waits for a full bucket and leaves it in debt.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now, cost=1):
+        # Seconds until `cost` tokens are available (0 = now)
+        self._refill(now)
+        need = min(cost, self.burst)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def take(self, now, cost=1):
+        self._refill(now)
+        self.tokens -= cost
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+def assigned_bot(user_id, usernames, unavailable=()):
+    # Delivery bot for a user. Rendezvous hashing: every user has a fixed order of preference over
+    # the bots, so a user keeps their bot, adding a bot only moves the users who now prefer it,
+    # and while a bot is unavailable (FloodWait) its users get their second choice.
+    # A bot can only message users who started it, so failover happens here, in the deep link.
+    ranked = sorted(usernames, key=lambda name: _bot_score(user_id, name), reverse=True)
+    for name in ranked:
+        if name not in unavailable:
+            return name
+    return ranked[0] # All unavailable: the first choice clears soonest as any other
+
+
+def _bot_score(user_id, username):
+    # Same in every process (unlike hash())
+    return int.from_bytes(hashlib.blake2b(f"{user_id}:{username}".encode(), digest_size=8).digest(), "big")
+
+
+class FloodTracker:
+    # Whether a bot as a whole is rate limited. A FloodWait is usually one chat's limit, which says
+    # nothing about the bot's other users; long waits (>= min_seconds) in `chats` distinct chats
+    # within `window` seconds do.
+    def __init__(self, min_seconds, chats, window):
+        self.min_seconds = min_seconds
+        self.chats = chats
+        self.window = window
+        self._waits = {} # chat_id -> monotonic time of its last long FloodWait
+
+    def record(self, chat_id, seconds, now):
+        # Seconds the whole bot should be considered limited for, or None
+        if seconds < self.min_seconds:
+            return None
+        self._waits[chat_id] = now
+        for stale in [c for c, at in self._waits.items() if now - at > self.window]:
+            del self._waits[stale]
+        return seconds if len(self._waits) >= self.chats else None
+
+
+class _Job:
+    __slots__ = ("chat_id", "send", "cost", "future", "enqueued_at", "attempts")
+
+    def __init__(self, chat_id, send, cost):
+        self.chat_id = chat_id
+        self.send = send
+        self.cost = cost
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class DeliveryQueue:
+    # Outgoing messages, paced to Telegram's limits: a global token bucket for the bot and one
+    # per chat. Chats are served round-robin, so one user asking for 20 files doesn't hold up
+    # everyone behind them. FloodWait pauses the chat for the time Telegram asks and the send is
+    # retried; other transient errors back off exponentially.
+    # send is any zero-argument coroutine function (e.g. a copy_message call), so a stub client
+    # can stand in for Telegram.
+    # on_flood_wait(chat_id, seconds) is awaited on every FloodWait, on_bot_error(error) on errors
+    # that are about the bot rather than the chat (auth, connection); e.g. to report the bot's health.
+    def __init__(self, global_rate, chat_rate, chat_burst, max_pending, max_per_chat, max_retries, concurrency,
+                 on_flood_wait=None, on_bot_error=None):
+        self.on_flood_wait = on_flood_wait
+        self.on_bot_error = on_bot_error
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.max_per_chat = max_per_chat
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._slots = asyncio.Semaphore(concurrency)
+
+        self._queues = {}         # chat_id -> deque of jobs
+        self._buckets = {}        # chat_id -> TokenBucket
+        self._paused = {}         # chat_id -> monotonic time its FloodWait/backoff ends
+        self._ready = deque()     # Chats that can send now, in round-robin order
+        self._delayed = []        # Heap of (ready_at, seq, chat_id) waiting on their bucket or a pause
+        self._scheduled = set()   # Chats in _ready or _delayed
+        self._seq = 0
+        self._pending = 0
+        self._wake = asyncio.Event()
+        self._task = None
+        self._in_flight = set()
+
+        # Metrics
+        self.delivered = 0
+        self.failed = 0
+        self.rejected = 0      # Queue full
+        self.retries = 0
+        self.flood_waits = 0
+        self._latencies = deque(maxlen=1000) # Seconds from submit to delivery, most recent
+
+    # --- LIFECYCLE ---
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        # Stop dispatching and give in-flight sends a moment to finish; queued ones are dropped
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._in_flight:
+            await asyncio.wait(self._in_flight, timeout=timeout)
+
+    # --- PRODUCERS ---
+    def submit(self, chat_id, send, cost=1):
+        # Returns a future with send()'s result, or None once the delivery has failed for good.
+        # cost = messages the send produces (e.g. a media group of 10 costs 10).
+        # Raises asyncio.QueueFull when the bot or this chat already has too much waiting.
+        queue = self._queues.get(chat_id)
+        if self._pending >= self.max_pending or (queue is not None and len(queue) >= self.max_per_chat):
+            self.rejected += 1
+            raise asyncio.QueueFull()
+        job = _Job(chat_id, send, cost)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+        queue.append(job)
+        self._pending += 1
+        self._schedule(chat_id, time.monotonic())
+        return job.future
+
+    # --- SCHEDULING ---
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id, now):
+        if chat_id in self._scheduled:
+            return
+        self._scheduled.add(chat_id)
+        queue = self._queues.get(chat_id)
+        cost = queue[0].cost if queue else 1
+        ready_at = max(now + self._bucket(chat_id).wait_time(now, cost), self._paused.get(chat_id, 0))
+        if ready_at <= now:
+            self._ready.append(chat_id)
+            self._wake.set()
+        else:
+            self._seq += 1
+            heapq.heappush(self._delayed, (ready_at, self._seq, chat_id))
+            if self._delayed[0][2] == chat_id:
+                self._wake.set() # Earlier than what the dispatcher is sleeping for
+
+    def _next_chat(self, now):
+        # Chat to send for next, or None. Due delayed chats join the back of the rotation.
+        while self._delayed and self._delayed[0][0] <= now:
+            self._ready.append(heapq.heappop(self._delayed)[2])
+        while self._ready:
+            chat_id = self._ready.popleft()
+            self._scheduled.discard(chat_id)
+            if not self._queues.get(chat_id):
+                continue
+            cost = self._queues[chat_id][0].cost
+            if self._paused.get(chat_id, 0) > now or self._bucket(chat_id).wait_time(now, cost) > 0:
+                self._schedule(chat_id, now)
+                continue
+            return chat_id
+        return None
+
+    def _sleep_time(self, now):
+        if self._ready:
+            return 0
+        if self._delayed:
+            return max(0, self._delayed[0][0] - now)
+        return None
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            now = time.monotonic()
+            wait = self._global.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            chat_id = self._next_chat(now)
+            if chat_id is not None:
+                wait = self._global.wait_time(now, self._queues[chat_id][0].cost)
+                if wait > 0:
+                    # Not enough global budget for this (bigger) send yet; keep the chat's turn
+                    self._ready.appendleft(chat_id)
+                    self._scheduled.add(chat_id)
+                    await asyncio.sleep(wait)
+                    continue
+            if chat_id is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self._sleep_time(now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            now = time.monotonic()
+            queue = self._queues.get(chat_id)
+            if not queue or self._paused.get(chat_id, 0) > now or self._bucket(chat_id).wait_time(now, queue[0].cost) > 0:
+                # Changed while waiting for the slot: a retry put a job back at the head and paused
+                # the chat (FloodWait). Pick again.
+                self._slots.release()
+                if queue:
+                    self._schedule(chat_id, now)
+                continue
+            job = queue.popleft()
+            self._global.take(now, job.cost)
+            self._bucket(chat_id).take(now, job.cost)
+            self._pending -= 1
+            if self._queues[chat_id]:
+                self._schedule(chat_id, now)
+            else:
+                del self._queues[chat_id]
+
+            task = asyncio.create_task(self._deliver(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+            if now - last_prune > 60:
+                self._prune(now)
+                last_prune = now
+
+    async def _deliver(self, job):
+        try:
+            job.attempts += 1
+            result = await job.send()
+        except FloodWait as e:
+            self.flood_waits += 1
+            self._retry(job, e.value, f"FloodWait {e.value}s")
+            await self._notify(self.on_flood_wait, job.chat_id, e.value)
+        except (BadRequest, Forbidden) as e:
+            # e.g. the user blocked the bot or the message is gone: retrying won't help
+            self._fail(job, e)
+        except Exception as e:
+            self._retry(job, min(60, 2 ** job.attempts), e)
+            if isinstance(e, (Unauthorized, OSError)):
+                await self._notify(self.on_bot_error, e)
+        else:
+            self.delivered += 1
+            self._latencies.append(time.monotonic() - job.enqueued_at)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    async def _notify(callback, *args):
+        if callback:
+            try:
+                await callback(*args)
+            except Exception as e:
+                logger.warning(f"{callback.__name__} failed: {e}")
+
+    def _retry(self, job, delay, reason):
+        if job.attempts > self.max_retries:
+            self._fail(job, reason)
+            return
+        self.retries += 1
+        now = time.monotonic()
+        self._paused[job.chat_id] = max(self._paused.get(job.chat_id, 0), now + delay)
+        # Back at the head of its chat's queue, so the chat keeps its order
+        self._queues.setdefault(job.chat_id, deque()).appendleft(job)
+        self._pending += 1
+        self._schedule(job.chat_id, now)
+
+    def _fail(self, job, reason):
+        self.failed += 1
+        logger.error(f"Delivery to {job.chat_id} failed after {job.attempts} attempts: {reason}")
+        if not job.future.done():
+            job.future.set_result(None)
+
+    def _prune(self, now):
+        # Forget idle chats whose bucket has refilled and whose pause is over
+        for chat_id in [c for c, bucket in self._buckets.items() if c not in self._queues and bucket.is_full(now)]:
+            del self._buckets[chat_id]
+        for chat_id in [c for c, until in self._paused.items() if until <= now]:
+            del self._paused[chat_id]
+
+    # --- METRICS ---
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(pct):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100))] if latencies else 0.0
+
+        return {
+            "queued": self._pending,
+            "chats_waiting": len(self._queues),
+            "in_flight": len(self._in_flight),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "flood_waits": self.flood_waits,
+            "latency_p50": percentile(50),
+            "latency_p99": percentile(99),
+        }
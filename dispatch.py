@@ -0,0 +1,190 @@
+import asyncio
+import functools
+import itertools
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Lane:
+    # A class of updates (user navigation, deliveries, indexing/admin) with its own bounded queue
+    # and its own worker tasks, so a burst in one lane can't take the workers of another.
+    # Pyrogram's workers only hand updates over, which never blocks.
+    # max_pending=0: unbounded, for updates that must not be lost.
+    def __init__(self, name, concurrency, max_pending):
+        self.name = name
+        self.concurrency = concurrency
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._workers = []
+        self.running = 0
+
+        # Metrics
+        self.processed = 0
+        self.errors = 0
+        self.shed = 0       # Refused: queue full
+        self._waits = deque(maxlen=1000) # Seconds from arrival to start, most recent
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, handler, *args):
+        # Future resolved (with None) once handler(*args) has run; None if the lane is full
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((time.monotonic(), handler, args, future))
+        except asyncio.QueueFull:
+            self.shed += 1
+            return None
+        return future
+
+    async def _work(self):
+        while True:
+            queued_at, handler, args, future = await self._queue.get()
+            self._waits.append(time.monotonic() - queued_at)
+            self.running += 1
+            try:
+                await handler(*args)
+            except Exception as e:
+                self.errors += 1
+                logger.exception(f"Handler {handler.__name__} failed in lane {self.name}: {e}")
+            finally:
+                self.running -= 1
+                self.processed += 1
+                if not future.done():
+                    future.set_result(None)
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def percentile(pct):
+            return waits[min(len(waits) - 1, int(len(waits) * pct / 100))] if waits else 0.0
+
+        return {
+            "queued": self._queue.qsize(),
+            "running": self.running,
+            "concurrency": self.concurrency,
+            "processed": self.processed,
+            "errors": self.errors,
+            "shed": self.shed,
+            "wait_p50": percentile(50),
+            "wait_p99": percentile(99),
+        }
+
+
+class Dispatcher:
+    # Lanes by name: {name: (concurrency, max_pending)}; max_pending 0 never sheds
+    def __init__(self, lanes):
+        self.lanes = {name: Lane(name, concurrency, max_pending) for name, (concurrency, max_pending) in lanes.items()}
+
+    def lane(self, name, on_shed=None):
+        # Decorator, under @app.on_*: the handler runs in lane `name`. on_shed(client, update) is
+        # awaited instead when the lane is full (e.g. to tell the user to try again).
+        # handler.submit(client, update) queues a call and returns its future (tests, load tests).
+        lane = self.lanes[name]
+
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(client, update):
+                if lane.submit(handler, client, update) is None:
+                    logger.warning(f"Lane {name} full, dropped {handler.__name__}")
+                    if on_shed:
+                        try:
+                            await on_shed(client, update)
+                        except Exception as e:
+                            logger.warning(f"on_shed failed: {e}")
+
+            wrapper.submit = lambda client, update: lane.submit(handler, client, update)
+            return wrapper
+        return decorator
+
+    def start(self):
+        for lane in self.lanes.values():
+            lane.start()
+
+    async def stop(self):
+        for lane in self.lanes.values():
+            await lane.stop()
+
+
+class Job:
+    def __init__(self, job_id, name, group):
+        self.id = job_id
+        self.name = name
+        self.group = group
+        self.started_at = time.time()
+        self.finished_at = None
+        self.status = "Starting..." # Set by the job as it goes
+        self.error = None
+        self.task = None
+
+    @property
+    def state(self):
+        if not self.task.done():
+            return "running"
+        if self.task.cancelled():
+            return "cancelled"
+        return "failed" if self.error else "done"
+
+    def describe(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return f"#{self.id} {self.name} - {self.state} ({elapsed:.0f}s): {self.status}"
+
+
+class JobManager:
+    # Long admin work (/index, /sync) as background tasks that can be listed and cancelled,
+    # instead of holding a handler until it finishes. Jobs in the same group don't overlap.
+    def __init__(self, keep=20):
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self.keep = keep # Finished jobs kept for /jobs
+
+    def start(self, name, run, group=None):
+        # run(job) is a coroutine function. Returns the Job, or None if a job of the group is running
+        if group is not None and any(j.group == group and j.state == "running" for j in self._jobs.values()):
+            return None
+        job = Job(next(self._ids), name, group)
+        job.task = asyncio.create_task(self._run(job, run))
+        self._jobs[job.id] = job
+        self._forget_old()
+        return job
+
+    async def _run(self, job, run):
+        try:
+            await run(job)
+        except asyncio.CancelledError:
+            job.status = "Cancelled"
+            raise
+        except Exception as e:
+            job.error = e
+            job.status = f"Failed: {e}"
+            logger.exception(f"Job {job.name} failed: {e}")
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None or job.state != "running":
+            return False
+        job.task.cancel()
+        return True
+
+    def jobs(self):
+        # Newest first
+        return sorted(self._jobs.values(), key=lambda job: job.id, reverse=True)
+
+    def _forget_old(self):
+        finished = [job for job in self.jobs() if job.state != "running"]
+        for job in finished[self.keep:]:
+            del self._jobs[job.id]
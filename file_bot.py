@@ -1,27 +1,187 @@
 import asyncio
-from pyrogram import Client, filters
-from pyrogram.types import Message
+import time
+from pyrogram import Client, filters, idle
+from pyrogram.handlers import MessageHandler
+from pyrogram.types import Message, InputMediaDocument, InputMediaVideo
 from config import Config
 from database import db
+from delivery import DeliveryQueue, FloodTracker
+from dispatch import Dispatcher
+from pyrogram.errors import BadRequest
 import logging
+import metrics
+from metrics import instrumented
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-if not Config.FILE_BOT_TOKEN:
+if not Config.FILE_BOT_TOKENS:
     logger.error("FILE_BOT_TOKEN is missing!")
     exit()
 
-app = Client(
-    "FileBot",
-    api_id=Config.API_ID,
-    api_hash=Config.API_HASH,
-    bot_token=Config.FILE_BOT_TOKEN,
-    workers=50
-)
+# The delivery bots this process runs (FILE_BOT_RUN, default all of FILE_BOT_TOKENS). Each bot has
+# its own Telegram rate limits; the index bot spreads users over the pool (see assigned_bot).
+apps = [
+    Client(
+        "FileBot" if i == 0 else f"FileBot{i}",
+        api_id=Config.API_ID,
+        api_hash=Config.API_HASH,
+        bot_token=Config.FILE_BOT_TOKENS[i],
+        workers=50
+    )
+    for i in (Config.FILE_BOT_RUN or range(len(Config.FILE_BOT_TOKENS)))
+]
+app = apps[0]
 
-@app.on_message(filters.private & filters.command("start"))
+# Deep links get their own handler budget and queue limit
+lanes = Dispatcher({
+    "deliveries": (Config.LANE_DELIVERY_CONCURRENCY, Config.LANE_DELIVERY_MAX_PENDING),
+})
+
+# Telegram's media group size limit
+MEDIA_GROUP_SIZE = 10
+
+def make_delivery(client):
+    floods = FloodTracker(Config.BOT_UNHEALTHY_FLOOD_SECONDS, Config.BOT_UNHEALTHY_FLOOD_CHATS,
+                          Config.BOT_UNHEALTHY_FLOOD_WINDOW)
+
+    async def report_flood_wait(chat_id, seconds):
+        # Only long waits across several chats take the bot out of new deep links; one chat's
+        # FloodWait is handled by pausing that chat
+        seconds = floods.record(chat_id, seconds, time.monotonic())
+        if seconds:
+            await db.report_bot_unhealthy(client.me.username, seconds)
+
+    async def report_bot_error(error):
+        await db.report_bot_unhealthy(client.me.username, Config.BOT_UNHEALTHY_ERROR_SECONDS)
+
+    return DeliveryQueue(
+        global_rate=Config.DELIVERY_GLOBAL_RATE,
+        chat_rate=Config.DELIVERY_CHAT_RATE,
+        chat_burst=Config.DELIVERY_CHAT_BURST,
+        max_pending=Config.DELIVERY_MAX_PENDING,
+        max_per_chat=Config.DELIVERY_MAX_PER_CHAT,
+        max_retries=Config.DELIVERY_MAX_RETRIES,
+        concurrency=Config.DELIVERY_CONCURRENCY,
+        on_flood_wait=report_flood_wait,
+        on_bot_error=report_bot_error
+    )
+
+# Every send goes through its bot's queue, paced to that bot's rate limits
+deliveries = {client: make_delivery(client) for client in apps}
+
+async def send_file(client, chat_id, file_doc, caption):
+    # By this bot's own file_id when it has one (no dependency on the channel message),
+    # otherwise copy from the channel once and record the file_id for next time
+    cached = (file_doc.get("file_ids") or {}).get(str(client.me.id))
+    if cached and cached["file_unique_id"] == file_doc.get("file_unique_id"):
+        try:
+            return await client.send_cached_media(
+                chat_id=chat_id,
+                file_id=cached["file_id"],
+                # Original caption: the one stored at index time
+                caption=(file_doc.get("caption") or "") if caption is None else caption
+            )
+        except BadRequest as e:
+            # Expired file reference and the like: fall back to a copy, which refreshes it
+            logger.warning(f"send_cached_media failed for {file_doc['_id']}: {e}")
+
+    # copy_message(chat_id, from_chat_id, message_id)
+    sent = await client.copy_message(
+        chat_id=chat_id,
+        from_chat_id=file_doc.get("chat_id") or Config.DB_CHANNEL_ID, # The channel it was indexed from
+        message_id=file_doc['message_id'],
+        caption=caption
+    )
+    media = sent.document or sent.video
+    if media:
+        await db.set_bot_file_id(file_doc, client.me.id, media)
+    return sent
+
+def build_caption(file_doc, caption_mode):
+    # 1. Original (None = keep it)
+    # 2. Anime - SxxExx - Quality
+    # 3. No Caption
+    if caption_mode == 1:
+        return None
+    if caption_mode == 2:
+        return f"**{file_doc['anime_name']}**\n" \
+               f"**Seasonal:** S{file_doc['season']:02d}E{file_doc['episode']:02d}\n" \
+               f"**Quality:** {file_doc['quality']}"
+    return ""
+
+def media_groups(file_docs):
+    # Runs of up to MEDIA_GROUP_SIZE files of the same media type (documents can't be mixed with videos)
+    group = []
+    for file_doc in file_docs:
+        if group and (len(group) == MEDIA_GROUP_SIZE or group[0].get("media_type") != file_doc.get("media_type")):
+            yield group
+            group = []
+        group.append(file_doc)
+    if group:
+        yield group
+
+async def send_group(client, chat_id, group, caption_mode, sent=None):
+    # One send_media_group when this bot has a file_id for every file; otherwise the files are
+    # sent one by one (copying the missing ones records their file_ids for next time).
+    # sent: how many files of the group went out one by one, kept by the caller across retries of
+    # the delivery job so a FloodWait halfway doesn't send the first files twice.
+    sent = sent if sent is not None else [0]
+    if len(group) > 1 and not sent[0]:
+        bot_key = str(client.me.id)
+        file_ids = []
+        for file_doc in group:
+            cached = (file_doc.get("file_ids") or {}).get(bot_key)
+            if not cached or cached["file_unique_id"] != file_doc.get("file_unique_id"):
+                break
+            file_ids.append(cached["file_id"])
+        else:
+            media = []
+            for file_doc, file_id in zip(group, file_ids):
+                caption = build_caption(file_doc, caption_mode)
+                caption = (file_doc.get("caption") or "") if caption is None else caption
+                input_media = InputMediaVideo if file_doc.get("media_type") == "video" else InputMediaDocument
+                media.append(input_media(file_id, caption=caption))
+            try:
+                return await client.send_media_group(chat_id, media)
+            except BadRequest as e:
+                logger.warning(f"send_media_group failed, sending files one by one: {e}")
+
+    for file_doc in group[sent[0]:]:
+        await send_file(client, chat_id, file_doc, build_caption(file_doc, caption_mode))
+        sent[0] += 1
+
+async def season_handler(client, message, payload):
+    # /start season_<anime_id>_<season>_<quality>: the whole season in one quality
+    try:
+        _, anime_id, season, quality = payload.split("_", 3)
+        anime_id, season = int(anime_id), int(season)
+    except ValueError:
+        return
+
+    # One query for the whole season
+    file_docs, caption_mode = await asyncio.gather(
+        db.get_season_files(anime_id, season, quality),
+        db.get_cached_setting("caption_mode", Config.CAPTION_MODE)
+    )
+    if not file_docs:
+        await message.reply_text("File not found or deleted.")
+        return
+
+    def sender(group):
+        sent = [0] # Shared by the retries of this group's job
+        return lambda: send_group(client, message.chat.id, group, caption_mode, sent)
+
+    try:
+        for group in media_groups(file_docs):
+            deliveries[client].submit(message.chat.id, sender(group), cost=len(group))
+    except asyncio.QueueFull:
+        logger.warning(f"Delivery queue full, season request from {message.chat.id} cut short")
+    await db.increase_view(file_docs[0]['anime_id'], file_docs[0]['anime_name'])
+
+@lanes.lane("deliveries")
+@instrumented
 async def start_handler(client: Client, message: Message):
     # format: /start file_<db_id>
     # or just: /start <db_id>
@@ -30,47 +190,34 @@ async def start_handler(client: Client, message: Message):
         return # Silent, no payload
         
     payload = message.command[1]
+    if payload.startswith("season_"):
+        await season_handler(client, message, payload)
+        return
     
     # Check if payload is a file request
     # Assuming payload is the file's ObjectId string from database
-    file_doc = await db.get_file(payload)
+    # Fetch Caption Settings alongside; both are usually answered from memory
+    file_doc, caption_mode = await asyncio.gather(
+        db.get_file(payload),
+        db.get_cached_setting("caption_mode", Config.CAPTION_MODE)
+    )
     
     if not file_doc:
         await message.reply_text("File not found or deleted.")
         return
-
-    # Fetch Caption Settings
-    caption_mode = await db.get_setting("caption_mode", Config.CAPTION_MODE) 
-    
-    # 1. Original
-    # 2. Anime - SxxExx - Quality
-    # 3. No Caption
     
-    caption = ""
-    if caption_mode == 1:
-        # We don't store original filename easily unless we look at the message in channel
-        # But we have db data. We can try to use saved info or empty.
-        # Actually message.copy usually keeps caption unless we override.
-        # If we want Original, we might pass None to caption?
-        caption = None 
-    elif caption_mode == 2:
-        caption = f"**{file_doc['anime_name']}**\n" \
-                  f"**Seasonal:** S{file_doc['season']:02d}E{file_doc['episode']:02d}\n" \
-                  f"**Quality:** {file_doc['quality']}"
-    elif caption_mode == 3:
-        caption = ""
+    caption = build_caption(file_doc, caption_mode)
 
-    try:
-        # copy_message(chat_id, from_chat_id, message_id)
-        await client.copy_message(
-            chat_id=message.chat.id,
-            from_chat_id=Config.DB_CHANNEL_ID,
-            message_id=file_doc['message_id'],
-            caption=caption
-        )
+    async def send():
+        sent = await send_file(client, message.chat.id, file_doc, caption)
         
         # Increase Trending Count since downloaded
-        await db.increase_view(file_doc['anime_name'])
+        await db.increase_view(file_doc['anime_id'], file_doc['anime_name'])
+        return sent
+
+    try:
+        # Queued; FloodWait and transient errors are retried by the delivery queue
+        deliveries[client].submit(message.chat.id, send)
         
         # Remove "NEW" badge logic is handled in Index Bot UI refresh or checking db
         # We can mark it as "viewed" for user?
@@ -99,6 +246,8 @@ async def start_handler(client: Client, message: Message):
         # Wait, if I delete "is_new" from DB, it's gone for everyone.
         # I'll stick to Time-Based usually, but let's just update view count here.
         
+    except asyncio.QueueFull:
+        logger.warning(f"Delivery queue full, dropped request from {message.chat.id}")
     except Exception as e:
         logger.error(f"Error sending file: {e}")
         # Silent fail or minimal error?
@@ -107,5 +256,47 @@ async def start_handler(client: Client, message: Message):
         # So if error, we stay silent.
         pass
 
+# Every bot in the pool answers /start <payload>
+for client in apps:
+    client.add_handler(MessageHandler(start_handler, filters.private & filters.command("start")))
+
+async def report_delivery(client, delivery):
+    # Queue depth and latency in the log, while there is traffic
+    last_delivered = 0
+    while True:
+        await asyncio.sleep(60)
+        stats = delivery.stats()
+        if stats["delivered"] != last_delivered or stats["queued"]:
+            logger.info(
+                f"Delivery @{client.me.username}: {stats['queued']} queued ({stats['chats_waiting']} chats), {stats['in_flight']} in flight, "
+                f"{stats['delivered']} delivered, {stats['failed']} failed, {stats['rejected']} rejected, "
+                f"{stats['flood_waits']} FloodWaits, latency p50 {stats['latency_p50']:.2f}s p99 {stats['latency_p99']:.2f}s"
+            )
+            last_delivered = stats["delivered"]
+
+async def main():
+    await db.migrate_catalog()
+    await db.ensure_indexes()
+    db.start()
+    lanes.start()
+    for client, delivery in deliveries.items():
+        await client.start()
+        delivery.start()
+        asyncio.create_task(report_delivery(client, delivery))
+    logger.info(f"Delivery bots: {', '.join('@' + client.me.username for client in apps)}")
+    if Config.FILE_BOT_METRICS_PORT:
+        for client, delivery in deliveries.items():
+            metrics.registry.register_stats(f"delivery_{client.me.username}", delivery.stats)
+        metrics.registry.register_stats("file_cache", db.file_cache.stats)
+        metrics.registry.register_stats("lane_deliveries", lanes.lanes["deliveries"].stats)
+        await metrics.serve(Config.METRICS_HOST, Config.FILE_BOT_METRICS_PORT)
+    await idle()
+    for client in apps:
+        await client.stop()
+    await lanes.stop()
+    for delivery in deliveries.values():
+        await delivery.stop()
+    await db.close()
+
 if __name__ == "__main__":
-    app.run()
+    app.run(main())
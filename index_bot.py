@@ -1,15 +1,24 @@
 import asyncio
 import time
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, 
     InputMediaPhoto
 )
 from pyrogram.errors import UserNotParticipant
 from config import Config
-from database import db
-from parsing import Parser
+from database import db, TRENDING_WINDOWS
+from membership import MembershipCache
+from render import RenderCache, badge_expiry
+from catalog import library_key
+from indexer import (
+    parse_message, reindex_channels, sync_channels, channels_text, mark_synced, index_lock, IndexStats
+)
+from dispatch import Dispatcher, JobManager
+from delivery import assigned_bot
 import logging
+import metrics
+from metrics import instrumented
 
 # Logging
 logging.basicConfig(level=logging.INFO)
@@ -27,18 +36,55 @@ app = Client(
     workers=50
 )
 
+# Users' navigation never waits behind channel uploads or admin work. Uploads queue without
+# limit, so none goes unindexed, and /jobs and /cancel answer even during an upload burst.
+lanes = Dispatcher({
+    "interactive": (Config.LANE_INTERACTIVE_CONCURRENCY, Config.LANE_INTERACTIVE_MAX_PENDING),
+    "uploads": (Config.LANE_UPLOAD_CONCURRENCY, 0),
+    "background": (Config.LANE_BACKGROUND_CONCURRENCY, Config.LANE_BACKGROUND_MAX_PENDING),
+    "control": (Config.LANE_CONTROL_CONCURRENCY, Config.LANE_CONTROL_MAX_PENDING),
+})
+# /index and /sync run as jobs: /jobs lists them, /cancel stops one
+jobs = JobManager()
+
+async def answer_busy(client, update):
+    if isinstance(update, CallbackQuery):
+        await update.answer("⏳ The bot is busy, please try again in a moment.")
+
 # --- HELPERS ---
 
-async def is_subscribed(user_id):
-    if not Config.FORCE_JOIN_CHANNEL_ID:
-        return True
+async def file_bot_for(user_id):
+    # The delivery bot this user's deep links point to; bots in a FloodWait are skipped
+    if len(Config.FILE_BOT_USERNAMES) == 1:
+        return Config.FILE_BOT_USERNAMES[0]
+    return assigned_bot(user_id, Config.FILE_BOT_USERNAMES, await db.get_flooded_bots())
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+async def fetch_membership(user_id):
     try:
         member = await app.get_chat_member(Config.FORCE_JOIN_CHANNEL_ID, user_id)
         return member.status in ["member", "administrator", "creator"]
     except UserNotParticipant:
         return False
     except Exception:
-        return True # Fail open if error
+        return None # Unknown (e.g. FloodWait), not cached
+
+membership = MembershipCache(
+    fetch_membership,
+    positive_ttl=Config.MEMBERSHIP_POSITIVE_TTL,
+    negative_ttl=Config.MEMBERSHIP_NEGATIVE_TTL,
+    maxsize=Config.MEMBERSHIP_CACHE_SIZE
+)
+
+async def is_subscribed(user_id, fresh=False):
+    if not Config.FORCE_JOIN_CHANNEL_ID:
+        return True
+    return await membership.is_member(user_id, fresh=fresh)
 
 async def get_force_join_markup():
     return InlineKeyboardMarkup([
@@ -58,6 +104,8 @@ async def check_force_join(client, message):
 # --- HANDLERS ---
 
 @app.on_message(filters.private & filters.command("start"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def start_handler(client, message):
     # Register user
     await db.add_user(
@@ -89,8 +137,11 @@ async def show_home_menu(message, is_edit=False):
         await message.reply_text(text, reply_markup=markup)
 
 @app.on_callback_query(filters.regex("^check_join$"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def check_join_callback(client, query):
-    if await is_subscribed(query.from_user.id):
+    # Always ask Telegram: a cached "not joined" would lock out users who just joined
+    if await is_subscribed(query.from_user.id, fresh=True):
         await query.answer("✅ Welcome back!", show_alert=False)
         await show_home_menu(query.message, is_edit=True)
     else:
@@ -98,25 +149,15 @@ async def check_join_callback(client, query):
 
 # --- AUTO INDEXING ---
 
-@app.on_message(filters.channel & filters.chat(Config.DB_CHANNEL_ID))
+@app.on_message(filters.channel & filters.chat(Config.DB_CHANNEL_IDS))
+@lanes.lane("uploads")
+@instrumented
 async def auto_index_handler(client, message):
     try:
-        if not (message.document or message.video):
-            return
-            
-        file_info = Parser.parse_info(
-            message.document.file_name if message.document else message.video.file_name,
-            message.caption
-        )
-        
+        file_info = parse_message(message)
         if not file_info:
             return
 
-        # Add metadata needed for DB
-        file_info['message_id'] = message.id
-        file_info['chat_id'] = message.chat.id
-        # We don't necessarily need file_unique_id for this logic but good to have
-        
         await db.save_file(file_info)
         logger.info(f"Indexed: {file_info['anime_name']} S{file_info['season']}E{file_info['episode']}")
         
@@ -126,32 +167,135 @@ async def auto_index_handler(client, message):
 # --- MANUAL INDEX ---
 
 @app.on_message(filters.command("index") & filters.user(Config.ADMIN_IDS))
+@lanes.lane("background")
+@instrumented
 async def manual_index_handler(client, message):
-    status_msg = await message.reply_text("🔄 **Starting Manual Indexing...**\nClearing old cache...")
-    await db.clear_index()
-    
-    count = 0
-    # Iterate history
-    async for msg in client.get_chat_history(Config.DB_CHANNEL_ID):
-        if msg.document or msg.video:
-            f_name = msg.document.file_name if msg.document else (msg.video.file_name if msg.video else "")
-            # Some videos might not have filename attribute populated in get_history sometimes, fallback to None
-            if not f_name: f_name = ""
-            
-            info = Parser.parse_info(f_name, msg.caption)
-            if info:
-                info['message_id'] = msg.id
-                info['chat_id'] = msg.chat.id
-                await db.save_file(info)
-                count += 1
-                if count % 50 == 0:
-                    await status_msg.edit_text(f"Indexing... {count} files processed.")
-                    
-    await status_msg.edit_text(f"✅ **Indexing Complete!**\nIndex Size: {count} files.")
+    async def run(job):
+        async with index_lock:
+            await run_full_index(client, message, job)
+
+    if index_lock.locked() or jobs.start("index", run, group="index") is None:
+        await message.reply_text("⏳ Indexing is already running. /jobs shows its progress.")
+
+async def run_full_index(client, message, job):
+    # Build into a shadow collection; the live catalog stays untouched until the swap
+    status_msg = await message.reply_text(f"🔄 **Starting Manual Indexing...** (job #{job.id}, /cancel {job.id} to stop)\nBuilding new index...")
+    await db.begin_shadow_index()
+
+    async def show_progress(progress):
+        job.status = IndexStats.total(progress.values()).progress_text()
+        await status_msg.edit_text(f"Indexing... {job.status}\n\n{channels_text(progress)}")
+
+    async def save_shadow(batch):
+        return await db.save_files(batch, shadow=True)
+
+    try:
+        results = await reindex_channels(client, Config.DB_CHANNEL_IDS, on_progress=show_progress, save=save_shadow)
+    except asyncio.CancelledError:
+        await db.abort_shadow_index()
+        await status_msg.edit_text("🛑 **Indexing Cancelled.** The existing index was kept.")
+        raise
+    except Exception as e:
+        logger.error(f"Manual Index Error: {e}")
+        await db.abort_shadow_index()
+        await status_msg.edit_text(f"❌ **Indexing Failed!**\n{e}\n\nThe existing index was kept.")
+        return
+
+    stats = IndexStats.total(results.values())
+    if not stats.indexed:
+        # Never swap an empty catalog over a working one
+        await db.abort_shadow_index()
+        await status_msg.edit_text(f"⚠️ **No files found.** The existing index was kept.\n{stats.report_text()}")
+        return
+
+    job.status = "Swapping in the new index"
+    await db.commit_shadow_index()
+    for chat_id, channel_stats in results.items():
+        await mark_synced(chat_id, channel_stats.newest_id)
+    job.status = f"{stats.indexed} files indexed"
+    await status_msg.edit_text(f"✅ **Indexing Complete!**\n{stats.report_text()}\n\n{channels_text(results)}")
+
+# --- INCREMENTAL SYNC ---
+
+@app.on_message(filters.command("sync") & filters.user(Config.ADMIN_IDS))
+@lanes.lane("background")
+@instrumented
+async def sync_handler(client, message):
+    async def run(job):
+        async with index_lock:
+            await run_sync(client, message, job)
+
+    if index_lock.locked() or jobs.start("sync", run, group="index") is None:
+        await message.reply_text("⏳ Indexing is already running. /jobs shows its progress.")
+
+async def run_sync(client, message, job):
+    status_msg = await message.reply_text(f"🔄 **Syncing new uploads...** (job #{job.id})")
+
+    async def show_progress(progress):
+        job.status = IndexStats.total(progress.values()).progress_text()
+        await status_msg.edit_text(f"Syncing... {job.status}\n\n{channels_text(progress)}")
+
+    try:
+        results = await sync_channels(client, Config.DB_CHANNEL_IDS, on_progress=show_progress)
+    except asyncio.CancelledError:
+        await status_msg.edit_text("🛑 **Sync Cancelled.** Run /sync again to resume.")
+        raise
+
+    synced = [result for result in results.values() if isinstance(result, IndexStats)]
+    failed = [result for result in results.values() if isinstance(result, Exception)]
+    if not synced and not failed:
+        job.status = "Already up to date"
+        await status_msg.edit_text("✅ **Already up to date.**")
+        return
+
+    stats = IndexStats.total(synced)
+    job.status = f"{stats.indexed} files indexed" + (f", {len(failed)} channels failed" if failed else "")
+    resumed = " (resumed)" if stats.resumed else ""
+    if failed:
+        title = f"⚠️ **Sync Finished With Errors{resumed}.** Run /sync again to resume."
+    else:
+        title = f"✅ **Sync Complete{resumed}!**"
+    await status_msg.edit_text(f"{title}\n{stats.report_text()}\n\n{channels_text(results)}")
+
+@app.on_message(filters.command("jobs") & filters.user(Config.ADMIN_IDS))
+@lanes.lane("control")
+@instrumented
+async def jobs_handler(client, message):
+    listed = jobs.jobs()
+    if not listed:
+        await message.reply_text("No jobs yet.")
+        return
+    await message.reply_text("⚙️ **Jobs**\n\n" + "\n".join(job.describe() for job in listed))
+
+@app.on_message(filters.command("cancel") & filters.user(Config.ADMIN_IDS))
+@lanes.lane("control")
+@instrumented
+async def cancel_handler(client, message):
+    try:
+        job_id = int(message.command[1])
+    except (IndexError, ValueError):
+        await message.reply_text("Usage: /cancel <job id> (see /jobs)")
+        return
+    if jobs.cancel(job_id):
+        await message.reply_text(f"🛑 Cancelling job #{job_id}...")
+    else:
+        await message.reply_text(f"Job #{job_id} is not running.")
+
+async def startup_sync():
+    try:
+        async with index_lock:
+            results = await sync_channels(app, Config.DB_CHANNEL_IDS)
+        for chat_id, stats in results.items():
+            if isinstance(stats, IndexStats):
+                logger.info(f"Startup sync of {chat_id}: {stats.indexed} files from {stats.scanned} messages")
+    except Exception as e:
+        logger.error(f"Startup Sync Error: {e}")
 
 # --- NAVIGATION HANDLERS ---
 
 @app.on_callback_query(filters.regex("^nav_"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def nav_handler(client, query: CallbackQuery):
     data = query.data
     user_id = query.from_user.id
@@ -159,16 +303,12 @@ async def nav_handler(client, query: CallbackQuery):
     # Ad Check (Skip for Favorites/Library usually? Prompt says flow is Force Join -> Ads -> Action)
     # Let's put ads on content access or major navigation
     # Simplify: Check ads on Library, Latest, Trending
-    if data in ["nav_library", "nav_latest", "nav_trending"]:
-        if not await db.check_ad_cooldown(user_id):
-            # Show Ad
+    if data in ["nav_library", "nav_latest"] or data.startswith("nav_trending"):
+        # At most one ad per AD_COOLDOWN_SECONDS; claiming the slot records the impression
+        if await db.claim_ad_slot(user_id):
             # For this MVP, we simulate an ad
             # Real ad would be a message or image
             # We will show an "Support Us" message with a "Continue" button
-            
-            # Update time so they don't see it immediately again
-            await db.update_ad_time(user_id)
-            
             await query.message.edit_text(
                 "💰 **Sponsored Advertisement**\n\nPlease support us by sharing this bot!",
                 reply_markup=InlineKeyboardMarkup([[
@@ -189,24 +329,15 @@ async def nav_handler(client, query: CallbackQuery):
         # State management uses user session usually. Or just simple on_message text.
         
     elif data == "nav_library":
-        # Show list of animes (Pagination needed for production, doing simple limit for now)
-        animes = await db.get_anime_list()
-        animes.sort()
-        
-        buttons = []
-        for name in animes[:50]: # Limit 50 to avoid big message
-            buttons.append([InlineKeyboardButton(name, callback_data=f"anime_{name}")])
-        
-        buttons.append([InlineKeyboardButton("🔙 Back", callback_data="nav_home")])
-        
-        await query.message.edit_text(
-            "📚 **Anime Library**",
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
-
-    elif data == "nav_trending":
-        trending = await db.get_trending()
-        message_text = "🔥 **Trending Anime**\n\n"
+        await show_library_page(query.message)
+
+    elif data.startswith("nav_trending"):
+        # nav_trending (last 24h) or nav_trending_{window}
+        window = data[len("nav_trending_"):] or "24h"
+        if window not in TRENDING_WINDOWS:
+            window = "24h"
+        trending = await db.get_trending(window)
+        message_text = f"🔥 **Trending Anime** ({TRENDING_WINDOWS[window][0]})\n\n"
         buttons = []
         if not trending:
             message_text += "No data yet."
@@ -215,33 +346,17 @@ async def nav_handler(client, query: CallbackQuery):
                 views = item.get("view_count", 0)
                 name = item["anime_name"]
                 message_text += f"• **{name}** - {views} views\n"
-                buttons.append([InlineKeyboardButton(name, callback_data=f"anime_{name}")])
+                buttons.append([InlineKeyboardButton(name, callback_data=f"anime_{item['anime_id']}")])
         
+        buttons.append([
+            InlineKeyboardButton(f"• {label} •" if key == window else label, callback_data=f"nav_trending_{key}")
+            for key, (label, _) in TRENDING_WINDOWS.items()
+        ])
         buttons.append([InlineKeyboardButton("🔙 Back", callback_data="nav_home")])
         await query.message.edit_text(message_text, reply_markup=InlineKeyboardMarkup(buttons))
 
     elif data == "nav_latest":
-        # We need to query episodes sorted by added_at
-        # Simplified: just show "Anime Library" but sorted by recent?
-        # Or explicit "New Episodes" list.
-        # DB: index_cache.find().sort("added_at", -1).limit(10)
-        cursor = db.index_cache.find().sort("added_at", -1).limit(10)
-        latest_eps = await cursor.to_list(length=10)
-        
-        text = "🆕 **Latest Episodes**\n"
-        buttons = []
-        for ep in latest_eps:
-             # Logic for NEW badge (24h)
-             is_recent = (time.time() - ep['added_at']) < (24 * 3600)
-             badge = "🔥 NEW" if is_recent else ""
-             
-             btn_text = f"{ep['anime_name']} S{ep['season']}E{ep['episode']} {badge}"
-             # Use callback to VIEW EPISODE directly?
-             # need unique id for that specific file doc
-             buttons.append([InlineKeyboardButton(btn_text, callback_data=f"file_{ep['_id']}")])
-             
-        buttons.append([InlineKeyboardButton("🔙 Back", callback_data="nav_home")])
-        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+        await show_latest_page(query.message)
 
     elif data == "nav_favorites":
         favs = await db.get_favorites(user_id)
@@ -252,85 +367,244 @@ async def nav_handler(client, query: CallbackQuery):
 
         buttons = []
         for f in favs:
-            buttons.append([InlineKeyboardButton(f['anime_name'], callback_data=f"anime_{f['anime_name']}")])
+            buttons.append([InlineKeyboardButton(f['anime_name'], callback_data=f"anime_{f['anime_id']}")])
         buttons.append([InlineKeyboardButton("🔙 Back", callback_data="nav_home")])
         
         await query.message.edit_text("❤️ **Your Favorites**", reply_markup=InlineKeyboardMarkup(buttons))
 
+# --- LATEST EPISODES ---
+
+async def show_latest_page(message, page=0):
+    # Served from the in-memory feed, newest first; no query
+    latest_eps, has_next = await db.get_latest(page, Config.LATEST_PAGE_SIZE)
+
+    text = "🆕 **Latest Episodes**\n" if latest_eps else "🆕 **Latest Episodes**\n\nNothing here yet."
+    buttons = []
+    now = time.time()
+    for ep in latest_eps:
+        # NEW badge: first indexed within the highlight window
+        is_recent = (now - ep['added_at']) < (Config.NEW_EPISODE_HIGHLIGHT_HOURS * 3600)
+        badge = "🔥 NEW" if is_recent else ""
+        btn_text = f"{ep['anime_name']} S{ep['season']}E{ep['episode']} {ep['quality']} {badge}"
+        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"file_{ep['file_id']}")])
+
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("◀️ Prev", callback_data=f"latest_{page - 1}"))
+    if has_next:
+        nav_row.append(InlineKeyboardButton("Next ▶️", callback_data=f"latest_{page + 1}"))
+    if nav_row:
+        buttons.append(nav_row)
+
+    buttons.append([InlineKeyboardButton("🔙 Back", callback_data="nav_home")])
+    await message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+
+@app.on_callback_query(filters.regex(r"^latest_(\d+)$"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
+async def latest_page_handler(client, query):
+    await show_latest_page(query.message, int(query.data.split("_", 1)[1]))
+
+# --- LIBRARY ---
+
+LIBRARY_JUMPS = ["#"] + [chr(c) for c in range(ord("A"), ord("Z") + 1)]
+
+def library_callback(op, cursor):
+    # lib_ge_{prefix}: page starting at prefix (A-Z jumps, any case).
+    # lib_gt_{anime_id} / lib_lt_{anime_id}: page after / before that anime.
+    # Telegram caps callback_data at 64 bytes, so long cursors are cut to fit.
+    prefix = f"lib_{op}_"
+    cursor = str(cursor).encode()[:64 - len(prefix)].decode(errors="ignore")
+    return prefix + cursor
+
+async def show_library_page(message, start=None, before=None):
+    page, has_prev, has_next = await db.get_anime_page(start, before, Config.LIBRARY_PAGE_SIZE)
+
+    buttons = []
+    for anime in page:
+        buttons.append([InlineKeyboardButton(anime["name"], callback_data=f"anime_{anime['_id']}")])
+
+    nav_row = []
+    if has_prev and page:
+        nav_row.append(InlineKeyboardButton("◀️ Prev", callback_data=library_callback("lt", page[0]["_id"])))
+    if has_next and page:
+        nav_row.append(InlineKeyboardButton("Next ▶️", callback_data=library_callback("gt", page[-1]["_id"])))
+    if nav_row:
+        buttons.append(nav_row)
+
+    # A-Z jump ("#" = start of the list: digits and symbols sort first)
+    jumps = [InlineKeyboardButton(c, callback_data=library_callback("ge", "" if c == "#" else c)) for c in LIBRARY_JUMPS]
+    for i in range(0, len(jumps), 7):
+        buttons.append(jumps[i:i + 7])
+
+    buttons.append([InlineKeyboardButton("🔙 Back", callback_data="nav_home")])
+
+    text = "📚 **Anime Library**" if page else "📚 **Anime Library**\n\nNo anime here."
+    await message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+
+@app.on_callback_query(filters.regex(r"^lib_(ge|gt|lt)_"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
+async def library_page_handler(client, query):
+    _, op, cursor = query.data.split("_", 2)
+    if op != "ge":
+        # Id cursor; keyboards sent before ids carry the name itself
+        anime = await resolve_anime(cursor)
+        if anime is None:
+            await show_library_page(query.message)
+            return
+        cursor = library_key(anime["name"])
+    if op == "lt":
+        await show_library_page(query.message, before=cursor)
+    elif op == "gt":
+        # Next page: strictly after the last anime shown
+        await show_library_page(query.message, start=cursor + "\x00")
+    else:
+        # Library keys start with the casefolded name
+        await show_library_page(query.message, start=cursor.casefold())
+
 # --- ANIME VIEW & EPISODES ---
 
+# Pre-rendered anime and season pages; dropped when their anime is re-indexed
+render_cache = RenderCache(Config.RENDER_CACHE_SIZE)
+db.add_change_listener(render_cache.invalidate)
+
+async def resolve_anime(token):
+    # Callback data carries the anime id; buttons sent before ids were introduced carry the name
+    if token.isdigit():
+        return await db.get_anime(int(token))
+    return await db.get_anime_by_name(token)
+
+def render_anime_page(anime):
+    # Everything but the favorite toggle, which differs per user
+    anime_id = anime["_id"]
+    rows = []
+    # Season Buttons (episode counts come from the stored summary)
+    row = []
+    for s in anime["seasons"]:
+        row.append(InlineKeyboardButton(f"Season {s['season']} ({s['episodes']})", callback_data=f"season_{anime_id}_{s['season']}"))
+        if len(row) == 3:
+            rows.append(row)
+            row = []
+    if row: rows.append(row)
+    
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data="nav_library")])
+    return f"📺 **{anime['name']}**\n\nSelect a season:", rows
+
+async def render_season_page(anime, season_num, page, file_bot):
+    # -> (text, rows, expires_at); expires when the first NEW badge on the page runs out.
+    # file_bot: username the download links point to
+    anime_id = anime["_id"]
+    episodes = await db.get_episodes(anime_id, season_num)
+    qualities = sorted({ep['quality'] for ep in episodes})
+    size = Config.SEASON_PAGE_SIZE
+    pages = max(1, -(-len(episodes) // size))
+    page = min(page, pages - 1)
+    episodes = episodes[page * size:(page + 1) * size]
+
+    now = time.time()
+    window = Config.NEW_EPISODE_HIGHLIGHT_HOURS * 3600
+    buttons = []
+    for ep in episodes:
+        is_recent = (now - ep['added_at']) < window
+        badge = "🔥" if is_recent else ""
+        btn_text = f"E{ep['episode']:02d} {badge}"
+        buttons.append(InlineKeyboardButton(btn_text, callback_data=f"file_{ep['_id']}"))
+        
+    # Group into grids of 4
+    rows = [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
+
+    if pages > 1:
+        nav_row = []
+        if page > 0:
+            nav_row.append(InlineKeyboardButton("◀️ Prev", callback_data=f"season_{anime_id}_{season_num}_{page - 1}"))
+        nav_row.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+        if page < pages - 1:
+            nav_row.append(InlineKeyboardButton("Next ▶️", callback_data=f"season_{anime_id}_{season_num}_{page + 1}"))
+        rows.append(nav_row)
+    
+    # Whole season in one quality, delivered by the File Bot as media groups
+    download = [
+        InlineKeyboardButton(f"📦 {quality}", url=f"https://t.me/{file_bot}?start=season_{anime_id}_{season_num}_{quality}")
+        for quality in qualities
+    ]
+    for i in range(0, len(download), 3):
+        rows.append(download[i:i + 3])
+
+    rows.append([InlineKeyboardButton("🔙 Back", callback_data=f"anime_{anime_id}")])
+    text = f"📺 **{anime['name']}** - Season {season_num}\n\nSelect an episode, or 📦 to download the whole season:"
+    return text, rows, badge_expiry(episodes, window, now)
+
 @app.on_callback_query(filters.regex("^anime_"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def anime_view_handler(client, query):
-    anime_name = query.data.split("_", 1)[1]
+    anime = await resolve_anime(query.data.split("_", 1)[1])
+    if not anime:
+        await query.answer("Anime not found!", show_alert=True)
+        return
     
     # Increase View Count (only on page open? "Anime page is opened" -> Yes)
-    await db.increase_view(anime_name)
-    
-    seasons = await db.get_seasons(anime_name)
-    seasons.sort()
-    
-    buttons = []
-    # Favorites Toggle
-    is_fav = await db.is_favorite(query.from_user.id, anime_name)
+    await db.increase_view(anime["_id"], anime["name"])
+    await show_anime_page(query, anime)
+
+async def show_anime_page(query, anime):
+    anime_id = anime["_id"]
+    key = (anime_id, None, 0)
+    page = render_cache.get(key)
+    if page is None:
+        page = render_anime_page(anime)
+        render_cache.set(key, *page)
+    text, rows = page
+
+    # Favorites Toggle, on top of the shared rows
+    is_fav = await db.is_favorite(query.from_user.id, anime_id)
     fav_text = "💔 Remove Favorite" if is_fav else "❤️ Add Favorite"
-    fav_data = f"favrem_{anime_name}" if is_fav else f"favadd_{anime_name}"
-    
-    buttons.append([InlineKeyboardButton(fav_text, callback_data=fav_data)])
-    
-    # Season Buttons
-    row = []
-    for s in seasons:
-        row.append(InlineKeyboardButton(f"Season {s}", callback_data=f"season_{anime_name}_S{s}"))
-        if len(row) == 3:
-            buttons.append(row)
-            row = []
-    if row: buttons.append(row)
-    
-    buttons.append([InlineKeyboardButton("🔙 Back", callback_data="nav_library")])
+    fav_data = f"favrem_{anime_id}" if is_fav else f"favadd_{anime_id}"
     
     await query.message.edit_text(
-        f"📺 **{anime_name}**\n\nSelect a season:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        text,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(fav_text, callback_data=fav_data)], *rows])
     )
 
+@app.on_callback_query(filters.regex(r"^noop$"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
+async def noop_handler(client, query):
+    # Label buttons (the page indicator): only stop the spinner
+    await query.answer()
+
 @app.on_callback_query(filters.regex(r"^season_"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def season_view_handler(client, query):
-    # format: season_{name}_S{number} -> careful with splitting name might have _
-    # better regex: season_(.*)_S(\d+)
+    # format: season_{anime_id}_{number}[_{page}]; older buttons: season_{name}_S{number}
     import re
-    match = re.search(r"season_(.*)_S(\d+)", query.data)
+    match = re.fullmatch(r"season_(\d+)_(\d+)(?:_(\d+))?", query.data) or re.search(r"season_(.*)_S(\d+)()", query.data)
     if not match: return
     
-    anime_name = match.group(1)
+    anime = await resolve_anime(match.group(1))
+    if not anime:
+        await query.answer("Anime not found!", show_alert=True)
+        return
     season_num = int(match.group(2))
+    page_num = int(match.group(3) or 0)
     
-    episodes = await db.get_episodes(anime_name, season_num)
+    # One cached copy per delivery bot, for the download links
+    file_bot = await file_bot_for(query.from_user.id)
+    key = (anime["_id"], season_num, page_num, file_bot)
+    page = render_cache.get(key)
+    if page is None:
+        text, rows, expires_at = await render_season_page(anime, season_num, page_num, file_bot)
+        render_cache.set(key, text, rows, expires_at)
+        page = text, rows
+    text, rows = page
     
-    buttons = []
-    for ep in episodes:
-        is_recent = (time.time() - ep['added_at']) < (24 * 3600)
-        badge = "🔥" if is_recent else ""
-        btn_text = f"E{ep['episode']:02d} {badge}"
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"file_{ep['_id']}")])
-        
-    # Group into grids of 4
-    grid = []
-    row = []
-    for btn in buttons:
-        row.append(btn[0])
-        if len(row) == 4:
-            grid.append(row)
-            row = []
-    if row: grid.append(row)
-    
-    grid.append([InlineKeyboardButton("🔙 Back", callback_data=f"anime_{anime_name}")])
-    
-    await query.message.edit_text(
-        f"📺 **{anime_name}** - Season {season_num}\n\nSelect an episode:",
-        reply_markup=InlineKeyboardMarkup(grid)
-    )
+    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(list(rows)))
 
 @app.on_callback_query(filters.regex(r"^file_"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def file_details_handler(client, query):
     file_id = query.data.split("_", 1)[1]
     file_doc = await db.get_file(file_id)
@@ -342,8 +616,12 @@ async def file_details_handler(client, query):
     text = f"💿 **{file_doc['anime_name']}**\n" \
            f"Season {file_doc['season']} - Episode {file_doc['episode']}\n" \
            f"Quality: {file_doc['quality']}\n" \
-           f"Audio: {file_doc['audio']}\n\n" \
-           f"Tap below to get the file!"
+           f"Audio: {file_doc['audio']}\n"
+    if file_doc.get('file_size'):
+        text += f"Size: {human_size(file_doc['file_size'])}\n"
+    if file_doc.get('duration'):
+        text += f"Duration: {file_doc['duration'] // 60} min\n"
+    text += "\nTap below to get the file!"
            
     # Generate Link to File Bot
     # t.me/FileBotUsername?start={file_id}
@@ -367,33 +645,41 @@ async def file_details_handler(client, query):
     # For now, I'll assume the user configures it.
     # Or, simpler: Just show the deep link format.
     
-    # Use Config defined username
-    file_bot_username = Config.FILE_BOT_USERNAME
+    # The user's own delivery bot from the pool
+    file_bot_username = await file_bot_for(query.from_user.id)
     
     buttons = [
         [InlineKeyboardButton("📥 Download File", url=f"https://t.me/{file_bot_username}?start={str(file_doc['_id'])}")],
-        [InlineKeyboardButton("🔙 Back", callback_data=f"season_{file_doc['anime_name']}_S{file_doc['season']}")]
+        [InlineKeyboardButton("🔙 Back", callback_data=f"season_{file_doc['anime_id']}_{file_doc['season']}")]
     ]
     
     await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
 
 # --- FAVORITES LOGIC ---
 @app.on_callback_query(filters.regex(r"^fav"))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def fav_handler(client, query):
-    action, name = query.data.split("_", 1)
+    action, token = query.data.split("_", 1)
+    anime = await resolve_anime(token)
+    if not anime:
+        await query.answer("Anime not found!", show_alert=True)
+        return
     if action == "favadd":
-        await db.add_favorite(query.from_user.id, name)
+        await db.add_favorite(query.from_user.id, anime["_id"], anime["name"])
         await query.answer("Added to Favorites!", show_alert=False)
     else:
-        await db.remove_favorite(query.from_user.id, name)
+        await db.remove_favorite(query.from_user.id, anime["_id"])
         await query.answer("Removed from Favorites!", show_alert=False)
     
-    # Refresh the Anime View
-    await anime_view_handler(client, query) # Re-render
+    # Refresh the Anime View (not a new view)
+    await show_anime_page(query, anime)
 
 # --- SEARCH TEXT HANDLER ---
 
-@app.on_message(filters.private & filters.text & ~filters.command(["start", "index", "admin"]))
+@app.on_message(filters.private & filters.text & ~filters.command(["start", "index", "sync", "admin", "flushjoin", "jobs", "cancel"]))
+@lanes.lane("interactive", on_shed=answer_busy)
+@instrumented
 async def search_handler(client, message):
     if not await check_force_join(client, message): return
     
@@ -405,8 +691,8 @@ async def search_handler(client, message):
         return
         
     buttons = []
-    for name in results:
-        buttons.append([InlineKeyboardButton(name, callback_data=f"anime_{name}")])
+    for anime in results:
+        buttons.append([InlineKeyboardButton(anime["name"], callback_data=f"anime_{anime['_id']}")])
         
     await message.reply_text(
         f"🔍 Results for '**{query}**':",
@@ -416,6 +702,8 @@ async def search_handler(client, message):
 # --- ADMIN PANEL ---
 
 @app.on_message(filters.command("admin") & filters.user(Config.ADMIN_IDS))
+@lanes.lane("background")
+@instrumented
 async def admin_panel(client, message):
     buttons = [
         [InlineKeyboardButton("📊 Stats", callback_data="admin_stats"),
@@ -426,16 +714,48 @@ async def admin_panel(client, message):
     await message.reply_text("👮‍♂️ **Admin Panel**", reply_markup=InlineKeyboardMarkup(buttons))
 
 @app.on_callback_query(filters.regex("^admin_stats"))
+@lanes.lane("background")
+@instrumented
 async def admin_stats(client, query):
     total_users = await db.get_total_users()
-    total_files = await db.index_cache.count_documents({})
-    await query.answer(f"Users: {total_users}\nFiles: {total_files}", show_alert=True)
+    total_files = await db.get_total_files()
+    catalog = db.catalog.stats()
+    views = db.view_counter.stats()
+    members = membership.stats()
+    pages = render_cache.stats()
+    await query.answer(
+        f"Users: {total_users}\nFiles: {total_files}\n"
+        f"Catalog cache: {catalog['cached_files']} files, {catalog['hit_rate']:.0%} hits\n"
+        f"Views: {views['flushed']} flushed, {views['buffered'] - views['flushed']} buffered\n"
+        f"Join cache: {members['hit_rate']:.0%} hits, {members['telegram_calls']} Telegram calls\n"
+        f"Page cache: {pages['pages']} pages, {pages['hit_rate']:.0%} hits",
+        show_alert=True
+    )
+
+@app.on_message(filters.command("flushjoin") & filters.user(Config.ADMIN_IDS))
+@lanes.lane("background")
+@instrumented
+async def flush_join_cache(client, message):
+    # /flushjoin -> everyone, /flushjoin <user_id> -> one user
+    if len(message.command) > 1:
+        try:
+            user_id = int(message.command[1])
+        except ValueError:
+            await message.reply_text("Usage: /flushjoin [user_id]")
+            return
+        membership.invalidate(user_id)
+        await message.reply_text(f"✅ Join status of {user_id} will be re-checked.")
+    else:
+        membership.invalidate()
+        await message.reply_text("✅ Join cache cleared.")
 
 # Note: Other Admin functions (Delete, Caption) would be extensive to implement fully with UI states.
 # I implemented the core "Re-index" via command /index.
 # I will implement basic toggle for Caption as an example.
 
 @app.on_callback_query(filters.regex("^admin_caption"))
+@lanes.lane("background")
+@instrumented
 async def admin_caption(client, query):
     # Toggle 1, 2, 3
     current = await db.get_setting("caption_mode", Config.CAPTION_MODE)
@@ -445,5 +765,40 @@ async def admin_caption(client, query):
     modes = {1: "Original", 2: "Clean", 3: "Empty"}
     await query.answer(f"Caption Mode set to: {modes[next_mode]}", show_alert=True)
 
+async def trending_job():
+    # Keeps the materialized trending lists fresh for nav_trending
+    while True:
+        try:
+            await db.materialize_trending()
+        except Exception as e:
+            logger.error(f"Trending Refresh Error: {e}")
+        await asyncio.sleep(Config.TRENDING_REFRESH_SECONDS)
+
+async def main():
+    await db.migrate_catalog()
+    await db.ensure_indexes()
+    await db.load_catalog()
+    await db.load_known_users()
+    await db.load_latest()
+    db.start()
+    lanes.start()
+    await app.start()
+    if Config.INDEX_BOT_METRICS_PORT:
+        metrics.registry.register_stats("catalog", db.catalog.stats)
+        metrics.registry.register_stats("render_cache", render_cache.stats)
+        metrics.registry.register_stats("membership_cache", membership.stats)
+        metrics.registry.register_stats("view_buffer", db.view_counter.stats)
+        metrics.registry.register_stats("new_user_buffer", db.new_users.stats)
+        for name, lane in lanes.lanes.items():
+            metrics.registry.register_stats(f"lane_{name}", lane.stats)
+        await metrics.serve(Config.METRICS_HOST, Config.INDEX_BOT_METRICS_PORT)
+    asyncio.create_task(trending_job())
+    if Config.SYNC_ON_STARTUP:
+        asyncio.create_task(startup_sync())
+    await idle()
+    await app.stop()
+    await lanes.stop()
+    await db.close()
+
 if __name__ == "__main__":
-    app.run()
+    app.run(main())
@@ -0,0 +1,309 @@
+import asyncio
+import time
+import logging
+from config import Config
+from database import db
+from parsing import Parser
+
+logger = logging.getLogger(__name__)
+
+# End-of-stream marker passed between pipeline stages
+_DONE = object()
+
+# Only one crawl (full /index, /sync or the startup sync) runs at a time
+index_lock = asyncio.Lock()
+
+
+def parse_message(msg):
+    # Channel message -> index_cache document (None if not a parsable video/document)
+    media = msg.document or msg.video
+    if not media:
+        return None
+
+    # Some videos might not have filename attribute populated in history, fallback to ""
+    info = Parser.parse_info(media.file_name or "", msg.caption)
+    if not info:
+        return None
+
+    info['message_id'] = msg.id
+    info['chat_id'] = msg.chat.id
+
+    # Media metadata, so files can be listed and sent without touching the channel message.
+    # file_id only works for the bot that received it (this one); see Database.set_bot_file_id
+    info['media_type'] = "video" if msg.video else "document"
+    info['file_id'] = media.file_id
+    info['file_unique_id'] = media.file_unique_id
+    info['file_size'] = media.file_size
+    info['mime_type'] = media.mime_type
+    info['duration'] = getattr(media, "duration", None) # Videos only
+    info['caption'] = msg.caption
+    return info
+
+
+class IndexStats:
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.scanned = 0         # Messages pulled from history
+        self.media = 0           # Messages with a video/document
+        self.parse_failures = 0  # Media the parser couldn't understand
+        self.upserted = 0        # New documents
+        self.updated = 0         # Existing documents that changed
+        self.unchanged = 0       # Existing documents that were already up to date
+        self.batches = 0
+        self.newest_id = 0       # Highest message_id seen
+        self.resumed = False     # Incremental sync picked up an interrupted run
+
+    @property
+    def elapsed(self):
+        end = self.finished_at or time.time()
+        return max(end - self.started_at, 0.001)
+
+    @property
+    def indexed(self):
+        return self.upserted + self.updated + self.unchanged
+
+    @classmethod
+    def total(cls, stats_list):
+        # Several channels' crawls as one
+        stats_list = list(stats_list)
+        total = cls()
+        if stats_list:
+            total.started_at = min(stats.started_at for stats in stats_list)
+            if all(stats.finished_at for stats in stats_list):
+                total.finished_at = max(stats.finished_at for stats in stats_list)
+        for field in ("scanned", "media", "parse_failures", "upserted", "updated", "unchanged", "batches"):
+            setattr(total, field, sum(getattr(stats, field) for stats in stats_list))
+        total.resumed = any(stats.resumed for stats in stats_list)
+        return total
+
+    def record(self, result):
+        if result is None:
+            return
+        self.batches += 1
+        self.upserted += result.upserted_count
+        self.updated += result.modified_count
+        self.unchanged += result.matched_count - result.modified_count
+
+    def progress_text(self):
+        return f"{self.scanned} messages scanned, {self.indexed} files saved " \
+               f"({self.scanned / self.elapsed:.0f} msg/s)"
+
+    def report_text(self):
+        return f"Index Size: {self.indexed} files.\n" \
+               f"Scanned: {self.scanned} messages ({self.media} media) in {self.elapsed:.1f}s\n" \
+               f"Throughput: {self.scanned / self.elapsed:.1f} msg/s, {self.indexed / self.elapsed:.1f} files/s\n" \
+               f"Parse failures: {self.parse_failures}\n" \
+               f"Upserts: {self.upserted} | Updated: {self.updated} | No-ops: {self.unchanged}"
+
+
+async def reindex_channel(client, chat_id, on_progress=None, save=None,
+                          batch_size=None, queue_size=None, progress_interval=None,
+                          offset_id=0, min_id=0, on_flush=None, stats=None):
+    # Producer/consumer crawl: history fetch -> parse -> batched upserts.
+    # Stages are connected by bounded queues so a slow DB applies back-pressure to the fetcher.
+    # History is walked newest first, from below offset_id (0 = latest) down to min_id (exclusive).
+    # on_flush(message_id) is awaited after each batch; everything newer than message_id is saved.
+    # stats: an IndexStats to fill in, for callers reporting on several crawls at once.
+    save = save or db.save_files
+    batch_size = batch_size or Config.INDEX_BATCH_SIZE
+    queue_size = queue_size or Config.INDEX_QUEUE_SIZE
+    progress_interval = progress_interval or Config.INDEX_PROGRESS_INTERVAL
+
+    stats = stats or IndexStats()
+    messages = asyncio.Queue(maxsize=queue_size)
+    docs = asyncio.Queue(maxsize=queue_size)
+
+    async def fetch():
+        async for msg in client.get_chat_history(chat_id, offset_id=offset_id):
+            if msg.id <= min_id:
+                break
+            stats.scanned += 1
+            stats.newest_id = max(stats.newest_id, msg.id)
+            await messages.put(msg)
+        await messages.put(_DONE)
+
+    async def parse():
+        while True:
+            msg = await messages.get()
+            if msg is _DONE:
+                await docs.put(_DONE)
+                return
+            if not (msg.document or msg.video):
+                continue
+            stats.media += 1
+            info = parse_message(msg)
+            if info is None:
+                stats.parse_failures += 1
+                continue
+            await docs.put(info)
+
+    async def write():
+        batch = []
+        while True:
+            info = await docs.get()
+            if info is not _DONE:
+                batch.append(info)
+            if batch and (info is _DONE or len(batch) >= batch_size):
+                stats.record(await save(batch))
+                if on_flush:
+                    await on_flush(batch[-1]["message_id"])
+                batch = []
+            if info is _DONE:
+                return
+
+    async def report():
+        # Time-throttled so big channels don't flood Telegram with edits
+        while True:
+            await asyncio.sleep(progress_interval)
+            try:
+                await on_progress(stats)
+            except Exception as e:
+                logger.warning(f"Index progress update failed: {e}")
+
+    stages = [asyncio.create_task(stage()) for stage in (fetch, parse, write)]
+    reporter = asyncio.create_task(report()) if on_progress else None
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        # If any stage failed, don't leave the others blocked on a queue
+        for task in stages:
+            task.cancel()
+        if reporter:
+            reporter.cancel()
+        stats.finished_at = time.time()
+
+    logger.info(f"Re-index of {chat_id} finished: {stats.scanned} messages, {stats.indexed} files, "
+                f"{stats.parse_failures} parse failures in {stats.elapsed:.1f}s")
+    return stats
+
+
+# --- INCREMENTAL SYNC ---
+# Per channel state lives in the settings collection:
+#   checkpoint: every message up to this id is indexed
+#   top/cursor: an unfinished run covering (checkpoint, top]; everything >= cursor is done
+
+def _sync_key(chat_id):
+    return f"sync_state_{chat_id}"
+
+
+async def latest_message_id(client, chat_id):
+    async for msg in client.get_chat_history(chat_id, limit=1):
+        return msg.id
+    return 0
+
+
+async def mark_synced(chat_id, message_id):
+    # Called after a full re-index so the next sync starts from there
+    await db.set_setting(_sync_key(chat_id), {"checkpoint": message_id})
+
+
+async def sync_channel(client, chat_id, on_progress=None, stats=None):
+    # Index only what was posted since the last checkpoint, resuming an interrupted run.
+    # Catches uploads auto_index_handler missed while the bot was down.
+    # Returns None when there is nothing new.
+    key = _sync_key(chat_id)
+    state = await db.get_setting(key)
+    if not state:
+        # Channel indexed before checkpoints existed: start from what is already in the index
+        # instead of crawling its whole history
+        state = {"checkpoint": await db.get_last_message_id(chat_id)}
+        await db.set_setting(key, state)
+
+    stats = stats or IndexStats()
+    synced = False
+    while True:
+        checkpoint = state.get("checkpoint", 0)
+        resumed = bool(state.get("top"))
+        if not resumed:
+            top = await latest_message_id(client, chat_id)
+            if top <= checkpoint:
+                break
+            state = {"checkpoint": checkpoint, "top": top, "cursor": top + 1}
+            await db.set_setting(key, state)
+
+        async def save_cursor(message_id):
+            state["cursor"] = message_id
+            await db.set_setting(key, state)
+
+        await reindex_channel(
+            client, chat_id,
+            on_progress=on_progress,
+            offset_id=state["cursor"],
+            min_id=checkpoint,
+            on_flush=save_cursor,
+            stats=stats
+        )
+        synced = True
+        stats.resumed = stats.resumed or resumed
+        state = {"checkpoint": state["top"]}
+        await db.set_setting(key, state)
+        if not resumed:
+            break
+        # The interrupted run only covered up to its old top: go on with what was posted since
+    return stats if synced else None
+
+
+# --- MULTIPLE CHANNELS ---
+# Storage is spread over Config.DB_CHANNEL_IDS. Every channel is crawled by its own pipeline, all
+# at once, so a re-index takes about as long as the biggest channel instead of the sum of them.
+
+async def _crawl_channels(chat_ids, crawl, on_progress=None, return_exceptions=False):
+    # crawl(chat_id, stats) per channel, concurrently -> {chat_id: result}.
+    # on_progress({chat_id: stats}) gets every channel in one call, time-throttled like a single crawl.
+    live = {chat_id: IndexStats() for chat_id in chat_ids}
+
+    async def report():
+        while True:
+            await asyncio.sleep(Config.INDEX_PROGRESS_INTERVAL)
+            try:
+                await on_progress(live)
+            except Exception as e:
+                logger.warning(f"Index progress update failed: {e}")
+
+    tasks = [asyncio.create_task(crawl(chat_id, live[chat_id])) for chat_id in chat_ids]
+    reporter = asyncio.create_task(report()) if on_progress else None
+    try:
+        results = await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    finally:
+        # One channel failing (or a cancel) stops the others
+        for task in tasks:
+            task.cancel()
+        if reporter:
+            reporter.cancel()
+    return dict(zip(chat_ids, results))
+
+
+async def reindex_channels(client, chat_ids, on_progress=None, save=None):
+    # Full crawl of every channel -> {chat_id: IndexStats}. Fails as a whole: the shadow index
+    # must not be committed with a channel missing.
+    return await _crawl_channels(
+        chat_ids, lambda chat_id, stats: reindex_channel(client, chat_id, save=save, stats=stats), on_progress
+    )
+
+
+async def sync_channels(client, chat_ids, on_progress=None):
+    # sync_channel for every channel -> {chat_id: IndexStats, None (up to date) or the exception}.
+    # Channels keep their own checkpoints, so one that fails doesn't hold back the others.
+    results = await _crawl_channels(
+        chat_ids, lambda chat_id, stats: sync_channel(client, chat_id, stats=stats), on_progress,
+        return_exceptions=True
+    )
+    for chat_id, result in results.items():
+        if isinstance(result, Exception):
+            logger.error(f"Sync of {chat_id} failed: {result}")
+    return results
+
+
+def channels_text(results):
+    # One line per channel, for status messages
+    lines = []
+    for chat_id, result in results.items():
+        if result is None:
+            state = "up to date"
+        elif isinstance(result, Exception):
+            state = f"failed: {result}"
+        else:
+            state = result.progress_text()
+        lines.append(f"`{chat_id}`: {state}")
+    return "\n".join(lines)
@@ -0,0 +1,42 @@
+from cache import TTLCache, SingleFlight, MISSING
+
+
+class MembershipCache:
+    # Force-join results per user. Members are cached for positive_ttl, non-members for the
+    # (shorter) negative_ttl. Concurrent lookups for the same user share one Telegram call.
+    # fetch(user_id) returns True/False, or None when Telegram couldn't answer (not cached).
+    def __init__(self, fetch, positive_ttl, negative_ttl, maxsize):
+        self._fetch = fetch
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize)
+        self._flight = SingleFlight()
+        self.telegram_calls = 0
+
+    async def is_member(self, user_id, fresh=False):
+        # fresh=True skips the cached answer (e.g. "I Joined") and stores the new one
+        if not fresh:
+            cached = self._cache.get(user_id)
+            if cached is not MISSING:
+                return cached
+        return await self._flight.do(user_id, lambda: self._lookup(user_id))
+
+    async def _lookup(self, user_id):
+        self.telegram_calls += 1
+        is_member = await self._fetch(user_id)
+        if is_member is None:
+            return True # Fail open if error, and ask again next time
+        self._cache.set(user_id, is_member, self.positive_ttl if is_member else self.negative_ttl)
+        return is_member
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(user_id)
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats["telegram_calls"] = self.telegram_calls
+        stats["coalesced"] = self._flight.coalesced
+        return stats
@@ -0,0 +1,235 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a cached page (~1ms) up to a slow Telegram call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    # One metric family, a series per label value tuple. pymongo calls its listeners from
+    # worker threads, so updates take a lock.
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = list(self._series.items())
+        for labels, value in sorted(series):
+            lines += self._render_series(labels, value)
+        return lines
+
+    def _render_series(self, labels, value):
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._series[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [per-bucket counts..., +Inf count], sum
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def _render_series(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + (bound,))} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._stats = [] # (prefix, stats function), read at scrape time
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def register_stats(self, prefix, stats):
+        # Every number in stats() (the caches' and queues' stats dicts) becomes a gauge prefix_<key>
+        self._stats.append((prefix, stats))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for prefix, stats in self._stats:
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(f"Metrics: {prefix} stats failed: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines += [f"# TYPE {prefix}_{key} gauge", f"{prefix}_{key} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Handler latency", ["handler"])
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Handlers that raised", ["handler"])
+DB_SECONDS = registry.histogram("bot_db_call_seconds", "Database method latency, Mongo and cache hits alike", ["method"])
+DB_ERRORS = registry.counter("bot_db_call_errors_total", "Database methods that raised", ["method"])
+MONGO_SECONDS = registry.histogram("mongo_command_seconds", "Mongo command round trips", ["command", "collection"])
+MONGO_FAILURES = registry.counter("mongo_command_failures_total", "Mongo commands that failed", ["command", "collection"])
+
+
+def instrumented(handler):
+    # For Pyrogram handlers: latency and errors. Goes under @app.on_* (and its lane).
+    # Saturation is per lane: lane_<name>_running against lane_<name>_concurrency.
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+def _timed(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+def instrument_methods(cls):
+    # Times every public coroutine method of cls (the Database class)
+    for name, method in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(method):
+            setattr(cls, name, _timed(method))
+    return cls
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    # Per command and collection timings, from the driver itself. Pass to the client as
+    # event_listeners=[MongoCommandListener()].
+    def __init__(self):
+        self._started = {} # request_id -> (command, collection)
+
+    def started(self, event):
+        # getMore carries the cursor id under its name and the collection under "collection"
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        if not isinstance(collection, str):
+            collection = "" # e.g. ping, or an aggregate on the database
+        self._started[(event.connection_id, event.request_id)] = (event.command_name, collection)
+
+    def succeeded(self, event):
+        labels = self._started.pop((event.connection_id, event.request_id), (event.command_name, ""))
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, *labels)
+
+    def failed(self, event):
+        labels = self._started.pop((event.connection_id, event.request_id), (event.command_name, ""))
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, *labels)
+        MONGO_FAILURES.inc(*labels)
+
+
+async def serve(host, port):
+    # Prometheus text format on http://host:port/metrics (any path, in fact)
+    async def handle(reader, writer):
+        try:
+            while (await reader.readline()).strip():
+                pass # Request line and headers; nothing in them matters
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -1,4 +1,110 @@
 import re
+from functools import lru_cache
+
+# Everything is compiled once at import; parsing a name is a handful of regex scans.
+_FLAGS = re.IGNORECASE
+
+# Not part of the name: [Group] tags, file extensions
+_JUNK = re.compile(r'\[.*?\]|\.(?:mkv|mp4|avi|flv|webm|m4v|mov)\b', _FLAGS)
+_SEPARATORS = re.compile(r'[._\s]+')
+
+# Token edges; \b would treat "_" and digits next to letters as part of the word
+_L = r'(?<![a-z0-9])'
+_R = r'(?![a-z0-9])'
+# Episode numbers that are really years
+_NOT_YEAR = r'(?!(?:19|20)\d\d(?!\d))'
+_VERSION = r'(?:v\d)?'
+
+# Season/episode rules, most specific first; the first rule that matches wins.
+# (name, pattern, last): the anime name is the text before the match,
+# `last` takes the last match instead of the first.
+EPISODE_RULES = [
+    # S01E05, S1E5, S01 E05, S01 - E05, S01EP05; also glued to the name (NarutoS01E05)
+    ("sxxexx", re.compile(r'(?<!\d)S(?P<season>\d{1,2})\s*(?:-\s*)?EP?\s*(?P<episode>\d{1,4})' + _VERSION + _R, _FLAGS), False),
+    # Season 1 Episode 5
+    ("season_episode", re.compile(_L + r'Season\s*(?P<season>\d{1,2})\s*[-,:]?\s*(?:Episode|Ep)\s*(?P<episode>\d{1,4})' + _R, _FLAGS), False),
+    # 1x05
+    ("nxnn", re.compile(_L + r'(?P<season>\d{1,2})x(?P<episode>\d{2,3})' + _R, _FLAGS), False),
+    # Episode 12, Ep 12, E12, #12
+    ("episode", re.compile(_L + r'(?:Episode|Ep|E|\#)\s*(?P<episode>\d{1,4})' + _VERSION + _R, _FLAGS), False),
+    # Name - 12 - Title, Name - 12 (1080p), Name - 1071
+    ("dash", re.compile(r'\s[-–]\s*' + _NOT_YEAR + r'(?P<episode>\d{1,4})' + _VERSION + r'(?=\s|$)'), False),
+    # Bare absolute numbers only with a version marker: Black Clover 170v2 1080p.
+    # Without a marker or a " - " a number can't be told from the title ("Mob Psycho 100",
+    # "Kaiju No. 8"), so "One Piece 1071 1080p" is left unparsed rather than misfiled.
+    ("absolute", re.compile(r'(?<=\s)' + _NOT_YEAR + r'(?P<episode>\d{1,4})v\d(?=\s|$)', _FLAGS), True),
+]
+
+# "Name Season 2", "Name S2", "Name 2nd Season" in front of an episode-only match
+_SEASON_SUFFIX = re.compile(
+    _L + r'(?:Season\s*(?P<season>\d{1,2})|S(?P<short>\d{1,2})|(?P<ordinal>\d{1,2})(?:st|nd|rd|th)\s+Season)\s*$', _FLAGS)
+_TRAILING_SEPARATORS = re.compile(r'[\s\-–:|,]+$')
+
+# Quality and audio come from one pass over the lowercased tokens of the text.
+# Token -> (value, precedence when several are present; lower wins)
+_TOKENS = re.compile(r'[a-z0-9]+')
+QUALITIES = {"2160p": ("2160p", 0), "4k": ("2160p", 0), "1080p": ("1080p", 1), "720p": ("720p", 2), "480p": ("480p", 3), "360p": ("360p", 4)}
+AUDIOS = {"multi": ("Multi", 0), "multiaudio": ("Multi", 0), "dual": ("Dual", 1), "dualaudio": ("Dual", 1),
+          "japanese": ("Japanese", 2), "jap": ("Japanese", 2), "jpn": ("Japanese", 2),
+          "english": ("English", 3), "eng": ("English", 3), "tamil": ("Tamil", 4)}
+
+_PARSE_CACHE_SIZE = 8192
+
+
+def _match_episode(text):
+    for _, pattern, last in EPISODE_RULES:
+        if last:
+            match = None
+            for match in pattern.finditer(text):
+                pass
+        else:
+            match = pattern.search(text)
+        # Numbers need a name in front of them
+        if match and (match.groupdict().get("season") or any(c.isalpha() for c in text[:match.start()])):
+            return match
+    return None
+
+
+def _scan_tags(text):
+    quality, audio = ("Unknown", 99), ("Original", 99)
+    for token in _TOKENS.findall(text.lower()):
+        found = QUALITIES.get(token)
+        if found is not None:
+            if found[1] < quality[1]:
+                quality = found
+            continue
+        found = AUDIOS.get(token)
+        if found is not None and found[1] < audio[1]:
+            audio = found
+    return quality[0], audio[0]
+
+
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def _parse(text):
+    # -> (anime_name, season, episode, quality, audio) or None; cached per distinct text
+    clean_text = _SEPARATORS.sub(' ', _JUNK.sub('', text)).strip()
+
+    match = _match_episode(clean_text)
+    if not match:
+        return None
+
+    episode = int(match.group("episode"))
+    season = match.groupdict().get("season")
+
+    # ANIME NAME LOGIC: Take ONLY text BEFORE the season/episode
+    anime_name = _TRAILING_SEPARATORS.sub('', clean_text[:match.start()])
+    if season is None:
+        suffix = _SEASON_SUFFIX.search(anime_name)
+        if suffix:
+            season = suffix.group("season") or suffix.group("short") or suffix.group("ordinal")
+            anime_name = _TRAILING_SEPARATORS.sub('', anime_name[:suffix.start()])
+    if not anime_name:
+        return None
+
+    # Tags are read from the whole text: "[1080p]" and "[Dual Audio]" live in brackets
+    quality, audio = _scan_tags(text)
+    return anime_name, int(season or 1), episode, quality, audio
+
 
 class Parser:
     @staticmethod
@@ -8,46 +114,12 @@ class Parser:
         if not text_to_parse:
             return None
 
-        # 2. Remove [bracket text], extensions
-        clean_text = re.sub(r'\[.*?\]', '', text_to_parse)
-        clean_text = re.sub(r'\.(mkv|mp4|avi|flv|webm)', '', clean_text, flags=re.IGNORECASE)
-        
-        # 3. Detect Season & Episode (SxxExx)
-        # Regex for S01E01, S1E1, etc.
-        # Use simple pattern specified in prompt rules
-        seek_pattern = r'(?i)S(\d+)E(\d+)'
-        match = re.search(seek_pattern, clean_text)
-        
-        if not match:
+        parsed = _parse(text_to_parse)
+        if parsed is None:
             return None
-            
-        season = int(match.group(1))
-        episode = int(match.group(2))
-        
-        # ANIME NAME LOGIC: Take ONLY text BEFORE SxxExx
-        # Match matches SxxExx, so we take string before start of match
-        raw_name = clean_text[:match.start()]
-        
-        # Clean up name: remove episode titles (usually after SxxExx, so already safe), clean dots/underscores
-        anime_name = raw_name.replace('.', ' ').replace('_', ' ').strip()
-        # Remove trailing hyphens or separators
-        anime_name = re.sub(r'[-–]+$', '', anime_name).strip()
-        
-        # 4. Detect Quality
-        quality = "Unknown"
-        if "1080p" in clean_text: quality = "1080p"
-        elif "720p" in clean_text: quality = "720p"
-        elif "480p" in clean_text: quality = "480p"
-        
-        # 5. Detect Audio
-        audio = "Original" # Default
-        lower_text = clean_text.lower()
-        if "multi" in lower_text: audio = "Multi"
-        elif "dual" in lower_text: audio = "Dual"
-        elif "japanese" in lower_text or "jap" in lower_text: audio = "Japanese"
-        elif "english" in lower_text or "eng" in lower_text: audio = "English"
-        elif "tamil" in lower_text: audio = "Tamil"
-        
+
+        # A fresh dict per call: callers add their own fields to it
+        anime_name, season, episode, quality, audio = parsed
         return {
             "anime_name": anime_name,
             "season": season,
@@ -55,3 +127,17 @@ class Parser:
             "quality": quality,
             "audio": audio
         }
+
+    @staticmethod
+    def parse_many(items):
+        # items: (filename, caption) pairs. Identical names (e.g. the same release
+        # re-posted, or re-indexing a channel) are only parsed once.
+        return [Parser.parse_info(filename, caption) for filename, caption in items]
+
+    @staticmethod
+    def cache_info():
+        return _parse.cache_info()
+
+    @staticmethod
+    def cache_clear():
+        _parse.cache_clear()
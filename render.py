@@ -0,0 +1,72 @@
+import math
+import time
+from collections import OrderedDict
+
+
+class RenderCache:
+    # Ready-made page texts and keyboard rows, keyed by (anime_id, season, page[, variant]); season
+    # None is the anime page itself. Rows are shared between users, so they must not be modified:
+    # per-user buttons (the favorite toggle) go in a new list around them.
+    # A page is dropped when its anime is re-indexed (invalidate) and expires on its own as
+    # soon as the first NEW badge on it runs out.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._pages = OrderedDict()  # key -> (expires_at, text, rows), LRU order
+        self._keys = {}              # anime_id -> {keys}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        # (text, rows) or None
+        entry = self._pages.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def set(self, key, text, rows, expires_at=math.inf):
+        self._pages[key] = (expires_at, text, tuple(rows))
+        self._pages.move_to_end(key)
+        self._keys.setdefault(key[0], set()).add(key)
+        while len(self._pages) > self.maxsize:
+            self._drop(next(iter(self._pages)))
+
+    def invalidate(self, anime_ids=None):
+        # None = everything (full re-index, catalog reload)
+        self.invalidations += 1
+        if anime_ids is None:
+            self._pages.clear()
+            self._keys.clear()
+            return
+        for anime_id in anime_ids:
+            for key in self._keys.pop(anime_id, ()):
+                self._pages.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "pages": len(self._pages),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+    def _drop(self, key):
+        self._pages.pop(key, None)
+        keys = self._keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[0]]
+
+
+def badge_expiry(docs, window, now=None):
+    # When the first NEW badge among docs (added_at within `window` seconds) runs out
+    now = time.time() if now is None else now
+    return min((doc["added_at"] + window for doc in docs if doc["added_at"] + window > now), default=math.inf)
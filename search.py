@@ -0,0 +1,198 @@
+import bisect
+import heapq
+import re
+import unicodedata
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize(text):
+    # Lowercase, strip accents, collapse punctuation/underscores/dots to single spaces
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _SEPARATORS.sub(" ", text.lower()).strip()
+
+
+def _grams(token):
+    # Padded trigrams, so short tokens and word edges still produce grams
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _max_typos(token):
+    if len(token) <= 3:
+        return 0
+    return 1 if len(token) <= 8 else 2
+
+
+def _edit_distance(a, b, limit):
+    # Levenshtein distance, giving up (limit + 1) as soon as it must exceed limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if limit == 1:
+        return _one_edit_apart(a, b)
+    # Only cells within `limit` of the diagonal can stay under the limit
+    over = limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        current = [over] * (len(b) + 1)
+        current[0] = i
+        for j in range(lo, hi + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != b[j - 1]))
+        if min(current[lo - 1:hi + 1]) > limit:
+            return over
+        previous = current
+    return min(previous[-1], over)
+
+
+def _one_edit_apart(a, b):
+    # Linear-time answer for limit == 1: 0, 1 or 2 (more than one edit)
+    if a == b:
+        return 0
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return 1 if a[i + 1:] == b[i + 1:] else 2
+    return 1 if a[i:] == b[i + 1:] else 2
+
+
+# Per query token match quality
+EXACT, PREFIX, SUBSTRING, TYPO = 1.0, 0.8, 0.6, 0.5
+
+
+class SearchIndex:
+    # In-memory anime title search: token index for exact/prefix matches plus a trigram
+    # index over the token vocabulary for substring and typo-tolerant matches.
+    # Every query token must match some token of the title; titles are ranked by match quality.
+    def __init__(self):
+        self._names = {}           # name id -> title
+        self._ids = {}             # title -> name id
+        self._name_tokens = {}     # name id -> normalized tokens
+        self._normalized = {}      # name id -> normalized title
+        self._postings = {}        # token -> {name ids}
+        self._vocabulary = []      # sorted tokens, for prefix ranges
+        self._gram_tokens = {}     # trigram -> {tokens}
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def rebuild(self, names):
+        self.__init__()
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name in self._ids:
+            return
+        name_id = self._next_id
+        self._next_id += 1
+        normalized = normalize(name)
+        tokens = set(normalized.split())
+        self._names[name_id] = name
+        self._ids[name] = name_id
+        self._normalized[name_id] = normalized
+        self._name_tokens[name_id] = tokens
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                bisect.insort(self._vocabulary, token)
+                for gram in _grams(token):
+                    self._gram_tokens.setdefault(gram, set()).add(token)
+            postings.add(name_id)
+
+    def remove(self, name):
+        name_id = self._ids.pop(name, None)
+        if name_id is None:
+            return
+        del self._names[name_id]
+        del self._normalized[name_id]
+        for token in self._name_tokens.pop(name_id):
+            postings = self._postings[token]
+            postings.discard(name_id)
+            if postings:
+                continue
+            del self._postings[token]
+            del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+            for gram in _grams(token):
+                tokens = self._gram_tokens[gram]
+                tokens.discard(token)
+                if not tokens:
+                    del self._gram_tokens[gram]
+
+    def search(self, query, limit=50):
+        normalized = normalize(query)
+        query_tokens = normalized.split()
+        if not query_tokens:
+            return []
+
+        # name id -> summed score; titles must match every query token
+        scores = None
+        for query_token in dict.fromkeys(query_tokens):
+            matches = {}
+            for token, score in self._match_token(query_token):
+                for name_id in self._postings[token]:
+                    if score > matches.get(name_id, 0):
+                        matches[name_id] = score
+            if scores is None:
+                scores = matches
+            else:
+                scores = {name_id: scores[name_id] + score for name_id, score in matches.items() if name_id in scores}
+            if not scores:
+                return []
+
+        def rank(name_id):
+            title = self._normalized[name_id]
+            bonus = 2.0 if title == normalized else 1.0 if title.startswith(normalized) else 0.0
+            return (-(scores[name_id] + bonus), len(title), self._names[name_id])
+
+        best = heapq.nsmallest(limit, scores, key=rank)
+        return [self._names[name_id] for name_id in best]
+
+    def _match_token(self, query_token):
+        # Yields (vocabulary token, score) for tokens matching query_token
+        seen = set()
+        start = bisect.bisect_left(self._vocabulary, query_token)
+        for token in self._vocabulary[start:]:
+            if not token.startswith(query_token):
+                break
+            seen.add(token)
+            yield token, EXACT if token == query_token else PREFIX
+
+        if len(query_token) < 3:
+            return
+
+        # Candidates share trigrams with the query token. One edit changes at most 3 grams,
+        # so anything sharing fewer than len(grams) - 3 * typos can't be within range.
+        grams = _grams(query_token)
+        typos = _max_typos(query_token)
+        shared = {}
+        for gram in grams:
+            for token in self._gram_tokens.get(gram, ()):
+                shared[token] = shared.get(token, 0) + 1
+        inner = len(grams) - 2  # grams of the query not touching the padding
+        needed = max(1, len(grams) - 3 * typos)
+        typo_candidates = []
+        for token, count in shared.items():
+            if token in seen:
+                continue
+            if count >= inner and query_token in token:
+                seen.add(token)
+                yield token, SUBSTRING
+            elif typos and count >= needed and abs(len(token) - len(query_token)) <= typos:
+                typo_candidates.append(token)
+
+        # Typos are the fallback for words that match nothing as typed
+        if seen:
+            return
+        for token in typo_candidates:
+            if _edit_distance(query_token, token, typos) <= typos:
+                yield token, TYPO
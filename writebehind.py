@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    # Collects writes in memory, merged per key, and flushes them as one unordered bulk_write
+    # every `interval` seconds or as soon as `max_pending` keys are waiting.
+    # Subclasses define how values merge (_merge) and which op a key becomes (_op).
+    def __init__(self, collection, interval, max_pending):
+        self.collection = collection
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._task = None
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+        # Metrics
+        self.buffered = 0   # Writes accepted
+        self.flushed = 0    # Writes that reached Mongo
+        self.flushes = 0    # bulk_write calls
+        self.errors = 0     # Failed flushes (their writes are re-queued)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Final flush on shutdown. The loop is asked to finish instead of being cancelled, so a
+        # flush in flight completes rather than losing the batch it swapped out.
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+        await self.flush()
+
+    def add(self, key, value):
+        self._merge(key, value)
+        self.buffered += self._weight(value)
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                failed = await self._write(batch)
+            except asyncio.CancelledError:
+                # Outcome unknown, as for a lost connection: keep the batch for the next flush
+                for key, value in batch.items():
+                    self._merge(key, value)
+                raise
+            self.flushes += 1
+            for key in failed:
+                # Back into the buffer for the next flush
+                self._merge(key, batch[key])
+            self.flushed += sum(self._weight(value) for key, value in batch.items() if key not in failed)
+            if failed:
+                self.errors += 1
+
+    async def _write(self, batch):
+        # Returns the keys that could not be written
+        keys = list(batch)
+        try:
+            await self.collection.bulk_write([self._op(key, batch[key]) for key in keys], ordered=False)
+            return set()
+        except BulkWriteError as e:
+            failed = [keys[error["index"]] for error in e.details["writeErrors"]]
+        except Exception as e:
+            # Unknown outcome (e.g. connection lost): retry everything later
+            logger.error(f"Write-behind flush to {self.collection.name} failed: {e}")
+            return set(keys)
+
+        # Typically a duplicate key: another process upserted the same new key first.
+        # The document exists now, so one retry turns the upsert into an update.
+        try:
+            await self.collection.bulk_write([self._op(key, batch[key]) for key in failed], ordered=False)
+            return set()
+        except BulkWriteError as e:
+            failed = {failed[error["index"]] for error in e.details["writeErrors"]}
+        except Exception:
+            failed = set(failed)
+        logger.error(f"Write-behind flush to {self.collection.name}: {len(failed)} writes re-queued")
+        return failed
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush error: {e}")
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "buffered": self.buffered,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "errors": self.errors,
+        }
+
+    def _merge(self, key, value):
+        raise NotImplementedError
+
+    def _op(self, key, value):
+        raise NotImplementedError
+
+    def _weight(self, value):
+        return 1
+
+
+class ViewCounterBuffer(WriteBehindBuffer):
+    # trending.view_count increments, summed per anime between flushes.
+    # $inc is applied atomically by the server, so several processes can flush concurrently.
+    def incr(self, anime_id, anime_name, count=1):
+        self.add((anime_id, anime_name), count)
+
+    def _merge(self, key, value):
+        self._pending[key] = self._pending.get(key, 0) + value
+
+    def _op(self, key, value):
+        anime_id, anime_name = key
+        return UpdateOne({"anime_id": anime_id}, {"$inc": {"view_count": value}, "$set": {"anime_name": anime_name}}, upsert=True)
+
+    def _weight(self, value):
+        return value
+
+
+class NewUserBuffer(WriteBehindBuffer):
+    # First sightings of users, inserted in bulk. $setOnInsert only: a user already in the
+    # collection (registered by another process, or before a restart) is left untouched.
+    def register(self, user_id, first_name, username):
+        self.add(user_id, {"first_name": first_name, "username": username, "joined_at": time.time()})
+
+    def _merge(self, key, value):
+        # The first sighting keeps its joined_at
+        self._pending.setdefault(key, value)
+
+    def _op(self, key, value):
+        return UpdateOne({"user_id": key}, {"$setOnInsert": value}, upsert=True)
+
+
+class HourlyViewBuffer(WriteBehindBuffer):
+    # Per anime, per hour view buckets (trending_hourly) behind the windowed trending lists.
+    # The hour is taken when the view happens, not when it is flushed.
+    def incr(self, anime_id, anime_name, count=1):
+        self.add((anime_id, anime_name, int(time.time() // 3600)), count)
+
+    def _merge(self, key, value):
+        self._pending[key] = self._pending.get(key, 0) + value
+
+    def _op(self, key, value):
+        anime_id, anime_name, hour = key
+        return UpdateOne(
+            {"hour": hour, "anime_id": anime_id},
+            {"$inc": {"views": value},
+             # TTL index on bucket_at drops buckets older than the longest window
+             "$setOnInsert": {"anime_name": anime_name, "bucket_at": datetime.fromtimestamp(hour * 3600, timezone.utc)}},
+            upsert=True
+        )
+
+    def _weight(self, value):
+        return value